@@ -3,18 +3,26 @@ Documents API - Upload, manage, and search documents
 """
 from fastapi import APIRouter, Depends, UploadFile, File, Form, HTTPException, Query
 from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy import func, select, tuple_
 from typing import Optional, List
 from pathlib import Path
+from datetime import datetime
+import asyncio
 import shutil
+import os
+import uuid
 
-from app.core.database import get_db_dependency
+from blake3 import blake3
+
+from app.core.database import get_db, get_db_dependency
 from app.core.config import settings
 from app.models.document import Document, DocumentStatus
 from app.models.chunk import Chunk
 from app.services.ingestion_service import IngestionService
 from app.services.vector_index_service import vector_index
+from app.services.ingestion_pipeline import ingestion_pipeline
 from app.schemas.document import (
     DocumentResponse, 
     DocumentListResponse, 
@@ -25,6 +33,70 @@ from app.schemas.document import (
 
 router = APIRouter(tags=["Documents"])
 
+ALLOWED_EXTENSIONS = frozenset({
+    ".pdf", ".docx", ".doc", ".txt", ".html", ".htm",
+    ".md", ".xlsx", ".xls", ".png", ".jpg", ".jpeg"
+})
+_ALLOWED_EXTENSIONS_TEXT = ", ".join(sorted(ALLOWED_EXTENSIONS))
+
+# Copy buffer for uploads that are still held in memory
+UPLOAD_COPY_BUFFER = 256 * 1024
+
+
+def _save_upload(src, dst, hasher=None) -> bool:
+    """
+    Copy an upload stream to an open destination file.
+    Uses zero-copy os.sendfile when the upload has been spooled to a real
+    file on disk, otherwise a buffered copy with a 256 KiB buffer. The
+    buffered copy also feeds `hasher`, so the content is hashed in the
+    same pass; returns True if it did.
+    """
+    src_fd = None
+    # SpooledTemporaryFile.fileno() would force an in-memory spool to disk,
+    # so only ask for a descriptor once it has already rolled over
+    if hasattr(os, "sendfile") and getattr(src, "_rolled", True):
+        try:
+            src_fd = src.fileno()
+        except (AttributeError, OSError, ValueError):
+            src_fd = None
+    
+    if src_fd is not None:
+        offset = src.tell()
+        size = os.fstat(src_fd).st_size
+        try:
+            while offset < size:
+                sent = os.sendfile(dst.fileno(), src_fd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+            return False
+        except OSError:
+            # Not supported for this fd pair; resume with a buffered copy.
+            # Only hash if nothing was sent yet.
+            if offset != src.tell():
+                hasher = None
+            src.seek(offset)
+    
+    if hasher is None:
+        shutil.copyfileobj(src, dst, length=UPLOAD_COPY_BUFFER)
+        return False
+    
+    for block in iter(lambda: src.read(UPLOAD_COPY_BUFFER), b""):
+        hasher.update(block)
+        dst.write(block)
+    return True
+
+
+def _write_upload(src, upload_path: Path) -> Optional[str]:
+    """
+    Write an upload stream to disk (blocking; run off the event loop).
+    Returns the content hash when it could be computed during the copy.
+    """
+    hasher = blake3()
+    with open(upload_path, "wb") as buffer:
+        hashed = _save_upload(src, buffer, hasher)
+    return hasher.hexdigest() if hashed else None
+
 
 @router.post("/upload", response_model=DocumentResponse)
 async def upload_document(
@@ -39,22 +111,24 @@ async def upload_document(
     """
     Upload and ingest a document.
     Supports PDF, DOCX, TXT, HTML, Markdown, and images (OCR).
+    The file is saved and registered, then queued on the ingestion
+    pipeline; the document is returned with status "pending" and moves
+    to "indexed" (or "failed") once parsing and embedding finish.
     """
     # Validate file type
-    allowed_extensions = {".pdf", ".docx", ".doc", ".txt", ".html", ".htm", 
-                          ".md", ".xlsx", ".xls", ".png", ".jpg", ".jpeg"}
     ext = Path(file.filename).suffix.lower()
-    if ext not in allowed_extensions:
+    if ext not in ALLOWED_EXTENSIONS:
         raise HTTPException(
             status_code=400, 
-            detail=f"Unsupported file type: {ext}. Allowed: {allowed_extensions}"
+            detail=f"Unsupported file type: {ext}. Allowed: {_ALLOWED_EXTENSIONS_TEXT}"
         )
     
     # Save file
     upload_path = settings.UPLOAD_DIR / file.filename
     try:
-        with open(upload_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # The copy is bounded by the spool/copy buffer; running it in the
+        # threadpool keeps large uploads from stalling the event loop
+        file_hash = await run_in_threadpool(_write_upload, file.file, upload_path)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to save file: {e}")
     
@@ -67,47 +141,20 @@ async def upload_document(
         "reliability_score": max(0.0, min(1.0, reliability_score))
     }
     
-    # Ingest document
+    # Register document
     try:
         ingestion_service = IngestionService(db)
-        document = ingestion_service.ingest_file(upload_path, metadata)
-        
-        # Add chunks to vector index
-        if document.status == DocumentStatus.INDEXED:
-            chunks = db.query(Chunk).filter(Chunk.document_id == document.id).all()
-            chunk_ids = [c.id for c in chunks]
-            contents = [c.content for c in chunks]
-            vector_index.add_chunks(chunk_ids, contents)
-            
-            # Update FTS index
-            for chunk in chunks:
-                db.execute(
-                    text("INSERT INTO chunks_fts (content, chunk_id) VALUES (:content, :chunk_id)"),
-                    {"content": chunk.content, "chunk_id": chunk.id}
-                )
-            db.commit()
-        
-        return DocumentResponse(
-            id=document.id,
-            filename=document.filename,
-            file_type=document.file_type.value,
-            status=document.status.value,
-            title=document.title,
-            author=document.author,
-            category=document.category,
-            tags=document.tags.split(",") if document.tags else None,
-            reliability_score=document.reliability_score,
-            page_count=document.page_count,
-            chunk_count=document.chunk_count,
-            created_at=document.created_at,
-            indexed_at=document.indexed_at,
-            error_message=document.error_message
-        )
-    
+        document, created = ingestion_service.register_file(upload_path, metadata, file_hash)
     except Exception as e:
         # Clean up file on failure
         upload_path.unlink(missing_ok=True)
         raise HTTPException(status_code=500, detail=f"Ingestion failed: {e}")
+    
+    # Parse, chunk, embed and index on the pipeline workers
+    if created:
+        await ingestion_pipeline.submit(document.id)
+    
+    return DocumentResponse.model_validate(document)
 
 
 @router.get("/", response_model=DocumentListResponse)
@@ -116,9 +163,23 @@ async def list_documents(
     page_size: int = Query(20, ge=1, le=100),
     status: Optional[str] = None,
     category: Optional[str] = None,
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
     db: Session = Depends(get_db_dependency)
 ):
-    """List all documents with pagination and filtering"""
+    """
+    List documents, newest first, with pagination and filtering.
+    Pass `cursor` (the `next_cursor` of the previous page) for keyset
+    pagination, which seeks on the (created_at, id) index instead of
+    skipping `(page - 1) * page_size` rows. id breaks ties, so documents
+    sharing a timestamp are neither skipped nor repeated.
+    """
+    if cursor:
+        try:
+            created_at, _, cursor_id = cursor.partition(",")
+            cursor_key = (datetime.fromisoformat(created_at), cursor_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    
     query = db.query(Document)
     
     if status:
@@ -126,30 +187,27 @@ async def list_documents(
     if category:
         query = query.filter(Document.category == category)
     
-    total = query.count()
-    documents = query.offset((page - 1) * page_size).limit(page_size).all()
+    # Plain COUNT(*) instead of Query.count()'s wrapping subquery
+    total = query.with_entities(func.count()).scalar()
+    
+    query = query.order_by(Document.created_at.desc(), Document.id.desc())
+    if cursor:
+        query = query.filter(tuple_(Document.created_at, Document.id) < cursor_key)
+    else:
+        query = query.offset((page - 1) * page_size)
+    documents = query.limit(page_size).all()
     
     return DocumentListResponse(
         documents=[
-            DocumentResponse(
-                id=d.id,
-                filename=d.filename,
-                file_type=d.file_type.value,
-                status=d.status.value,
-                title=d.title,
-                author=d.author,
-                category=d.category,
-                tags=d.tags.split(",") if d.tags else None,
-                reliability_score=d.reliability_score,
-                page_count=d.page_count,
-                chunk_count=d.chunk_count,
-                created_at=d.created_at,
-                indexed_at=d.indexed_at
-            ) for d in documents
+            DocumentResponse.model_validate(d) for d in documents
         ],
         total=total,
         page=page,
-        page_size=page_size
+        page_size=page_size,
+        next_cursor=(
+            f"{documents[-1].created_at.isoformat()},{documents[-1].id}"
+            if len(documents) == page_size else None
+        )
     )
 
 
@@ -163,22 +221,7 @@ async def get_document(
     if not document:
         raise HTTPException(status_code=404, detail="Document not found")
     
-    return DocumentResponse(
-        id=document.id,
-        filename=document.filename,
-        file_type=document.file_type.value,
-        status=document.status.value,
-        title=document.title,
-        author=document.author,
-        category=document.category,
-        tags=document.tags.split(",") if document.tags else None,
-        reliability_score=document.reliability_score,
-        page_count=document.page_count,
-        chunk_count=document.chunk_count,
-        created_at=document.created_at,
-        indexed_at=document.indexed_at,
-        error_message=document.error_message
-    )
+    return DocumentResponse.model_validate(document)
 
 
 @router.get("/{document_id}/chunks", response_model=List[ChunkResponse])
@@ -225,17 +268,15 @@ async def delete_document(
         raise HTTPException(status_code=404, detail="Document not found")
     
     # Get chunk IDs for vector index cleanup
-    chunk_ids = [c.id for c in db.query(Chunk.id).filter(Chunk.document_id == document_id).all()]
+    chunk_ids = db.execute(select(Chunk.id).where(Chunk.document_id == document_id)).scalars().all()
     
-    # Remove from vector index
+    # Remove from vector index (off the event loop: it can write the index file)
     if chunk_ids:
-        vector_index.remove_chunks(chunk_ids)
-        
-        # Remove from FTS
-        for cid in chunk_ids:
-            db.execute(text("DELETE FROM chunks_fts WHERE chunk_id = :chunk_id"), {"chunk_id": cid})
+        await asyncio.to_thread(vector_index.remove_chunks, chunk_ids)
     
-    # Delete document (cascades to chunks)
+    # One bulk DELETE for the chunks (the chunks_ad trigger clears FTS),
+    # then the document itself
+    db.query(Chunk).filter(Chunk.document_id == document_id).delete(synchronize_session=False)
     db.delete(document)
     db.commit()
     
@@ -246,58 +287,56 @@ async def delete_document(
     return {"status": "deleted", "document_id": document_id}
 
 
-@router.post("/{document_id}/reindex")
-async def reindex_document(
-    document_id: str,
-    db: Session = Depends(get_db_dependency)
-):
-    """Re-ingest a document (useful after updating ingestion logic)"""
-    document = db.query(Document).filter(Document.id == document_id).first()
-    if not document:
-        raise HTTPException(status_code=404, detail="Document not found")
-    
-    # Delete existing chunks
-    chunk_ids = [c.id for c in db.query(Chunk.id).filter(Chunk.document_id == document_id).all()]
-    if chunk_ids:
-        vector_index.remove_chunks(chunk_ids)
-        db.query(Chunk).filter(Chunk.document_id == document_id).delete()
-        db.commit()
-    
-    # Re-ingest
-    ingestion_service = IngestionService(db)
-    filepath = Path(document.filepath)
-    
-    if not filepath.exists():
-        raise HTTPException(status_code=404, detail="Source file no longer exists")
-    
-    # Process document again
-    metadata = {
-        "title": document.title,
-        "author": document.author,
-        "category": document.category,
-        "tags": document.tags,
-        "reliability_score": document.reliability_score
-    }
-    
-    try:
-        chunks = ingestion_service._process_document(document, filepath)
-        for chunk in chunks:
-            chunk.document_id = document.id
-            db.add(chunk)
+def _reindex(document_id: str) -> int:
+    """
+    Re-parse and re-embed a document, then swap its chunks in one commit
+    (blocking; run off the event loop). The new chunks are embedded
+    before the swap, so any failure leaves the old rows and vectors live.
+    Returns the new chunk count.
+    """
+    with get_db() as db:
+        document = db.query(Document).filter(Document.id == document_id).first()
+        if not document:
+            raise HTTPException(status_code=404, detail="Document not found")
+        # The pipeline owns PENDING/PROCESSING documents' chunks
+        if document.status in (DocumentStatus.PENDING, DocumentStatus.PROCESSING):
+            raise HTTPException(status_code=409, detail="Document is still being indexed")
         
-        document.chunk_count = len(chunks)
-        document.status = DocumentStatus.INDEXED
-        db.commit()
+        filepath = Path(document.filepath)
+        if not filepath.exists():
+            raise HTTPException(status_code=404, detail="Source file no longer exists")
         
-        # Update indices
-        chunk_ids = [c.id for c in chunks]
-        contents = [c.content for c in chunks]
-        vector_index.add_chunks(chunk_ids, contents)
+        old_chunk_ids = db.execute(select(Chunk.id).where(Chunk.document_id == document_id)).scalars().all()
         
-        return {"status": "reindexed", "chunk_count": len(chunks)}
+        ingestion_service = IngestionService(db)
+        chunk_ids: list = []
+        try:
+            chunks = ingestion_service._process_document(document, filepath)
+            for chunk in chunks:
+                chunk["id"] = str(uuid.uuid4())  # Needed before store_chunks()
+            chunk_ids = [c["id"] for c in chunks]
+            vector_index.add_chunks(chunk_ids, [c["content"] for c in chunks], False)
+            
+            db.query(Chunk).filter(Chunk.document_id == document_id).delete(synchronize_session=False)
+            ingestion_service.store_chunks(chunks)
+            
+            document.chunk_count = len(chunks)
+            document.status = DocumentStatus.INDEXED
+            document.indexed_at = datetime.utcnow()
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            vector_index.remove_chunks(chunk_ids, False)
+            raise HTTPException(status_code=500, detail=f"Reindex failed: {e}")
     
-    except Exception as e:
-        document.status = DocumentStatus.FAILED
-        document.error_message = str(e)
-        db.commit()
-        raise HTTPException(status_code=500, detail=f"Reindex failed: {e}")
+    # Drop the old vectors and write the index to disk once
+    vector_index.remove_chunks(old_chunk_ids, False)
+    vector_index.flush()
+    return len(chunk_ids)
+
+
+@router.post("/{document_id}/reindex")
+async def reindex_document(document_id: str):
+    """Re-ingest a document (useful after updating ingestion logic)"""
+    chunk_count = await asyncio.to_thread(_reindex, document_id)
+    return {"status": "reindexed", "chunk_count": chunk_count}
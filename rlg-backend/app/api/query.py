@@ -1,19 +1,19 @@
 """
 Query API - The main Q&A endpoint with grounded responses
 """
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, Request
 from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from sqlalchemy import func
 from typing import Optional, List, AsyncGenerator
 from datetime import datetime
 import time
-import json
+import orjson
+import uuid
 
-from app.core.database import get_db_dependency
+from app.core.database import get_db, get_db_dependency
 from app.core.config import settings
-from app.models.query import Query
-from app.models.answer import Answer
+from app.models.query import Query, QueryStats
+from app.models.answer import Answer, AnswerChunkLink
 from app.schemas.query import QueryRequest
 from app.schemas.answer import (
     AnswerResponse, 
@@ -26,14 +26,36 @@ from app.services.retrieval_service import RetrievalService
 from app.services.context_service import ContextService
 from app.services.llm_service import llm_service, extractive_llm
 from app.services.validation_service import validation_service
+from app.services.query_batcher import query_batcher
+from app.api.responses import negotiate
 
 
 router = APIRouter(tags=["Query"])
 
 
+def _persist_analytics(
+    query_record: Query,
+    answer_record: Answer,
+    links: List[AnswerChunkLink]
+):
+    """
+    Background task: store a finished query, its answer, the sentence to
+    chunk links and the running stats in one transaction, after the
+    response has been sent.
+    """
+    with get_db() as db:
+        db.add(query_record)
+        db.add(answer_record)
+        db.add_all(links)
+        QueryStats.record(db, query_record)
+        db.commit()
+
+
 @router.post("/", response_model=AnswerResponse | NoAnswerResponse)
 async def ask_question(
     request: QueryRequest,
+    http_request: Request,
+    background: BackgroundTasks,
     db: Session = Depends(get_db_dependency)
 ):
     """
@@ -47,29 +69,32 @@ async def ask_question(
     """
     start_time = time.time()
     
-    # Create query record for analytics
+    # Query record for analytics. The id is generated here so the response
+    # can reference it; the row itself is written in the background.
     query_record = Query(
+        id=str(uuid.uuid4()),
         question=request.question,
         query_type="question"
     )
-    db.add(query_record)
-    db.flush()
     
     try:
-        # Step 1: Retrieval
+        # Step 1: Retrieval. The question is embedded together with any
+        # other in-flight questions
         retrieval_start = time.time()
+        query_embedding = await query_batcher.embed(request.question)
         retrieval_service = RetrievalService(db)
         chunks = retrieval_service.retrieve(
             query=request.question,
             document_ids=request.document_ids,
             categories=request.categories,
             min_reliability=request.min_reliability,
-            top_k=request.top_k * 2  # Retrieve more, filter later
+            top_k=request.top_k * 2,  # Retrieve more, filter later
+            query_embedding=query_embedding
         )
         retrieval_time = int((time.time() - retrieval_start) * 1000)
         
         if not chunks:
-            return NoAnswerResponse(
+            return negotiate(http_request, NoAnswerResponse(
                 reason="No relevant documents found",
                 suggestions=[
                     "Try rephrasing your question",
@@ -77,7 +102,7 @@ async def ask_question(
                     "Broaden your search categories"
                 ],
                 sources_checked=0
-            )
+            ))
         
         query_record.chunks_retrieved = len(chunks)
         query_record.retrieval_time_ms = retrieval_time
@@ -87,11 +112,11 @@ async def ask_question(
         context, context_chunks = context_service.build_context(chunks, request.question)
         
         if not context_chunks:
-            return NoAnswerResponse(
+            return negotiate(http_request, NoAnswerResponse(
                 reason="Retrieved content too short or irrelevant",
                 suggestions=["Provide more detailed documents"],
                 sources_checked=len(chunks)
-            )
+            ))
         
         # Step 3: Generate answer with grounding prompt
         generation_start = time.time()
@@ -101,7 +126,7 @@ async def ask_question(
             context_chunks=context_chunks
         )
         
-        llm_response = llm_service.generate(
+        llm_response = await llm_service.generate_async(
             prompt=prompt,
             temperature=0.1,  # Low temperature for factual responses
             max_tokens=settings.MAX_GENERATION_TOKENS
@@ -126,7 +151,7 @@ async def ask_question(
                 validation_result
             )
             if should_reject:
-                return NoAnswerResponse(
+                return negotiate(http_request, NoAnswerResponse(
                     reason=rejection_reason or "Answer failed grounding validation",
                     suggestions=[
                         "The sources may not contain this information",
@@ -134,7 +159,11 @@ async def ask_question(
                     ],
                     partial_info=llm_response.text[:200] + "..." if len(llm_response.text) > 200 else llm_response.text,
                     sources_checked=len(chunks)
-                )
+                ))
+        
+        # Index chunks by id for O(1) lookups while building the response
+        context_by_id = {c.chunk_id: c for c in context_chunks}
+        retrieved_by_id = {c.chunk_id: c for c in chunks}
         
         # Build response with grounded sentences
         grounded_sentences = []
@@ -142,14 +171,11 @@ async def ask_question(
             citations = []
             for chunk_id, excerpt in zip(result.matched_chunks, result.matched_excerpts):
                 # Find the context chunk
-                matching_context = next(
-                    (c for c in context_chunks if c.chunk_id == chunk_id), 
-                    None
-                )
+                matching_context = context_by_id.get(chunk_id)
                 if matching_context:
                     citations.append(SourceCitation(
                         chunk_id=chunk_id,
-                        document_name=matching_context.citation.split("|")[0].strip(),
+                        document_name=matching_context.citation.partition("|")[0].strip(),
                         excerpt=excerpt,
                         relevance_score=result.confidence,
                         match_type=result.match_type
@@ -163,40 +189,55 @@ async def ask_question(
             ))
         
         # Build source citations
-        sources_used = []
-        for chunk in context_chunks[:request.top_k]:
-            retrieved = next((c for c in chunks if c.chunk_id == chunk.chunk_id), None)
-            sources_used.append(SourceCitation(
+        sources_used = [
+            SourceCitation(
                 chunk_id=chunk.chunk_id,
-                document_name=chunk.citation.split("|")[0].strip() if "|" in chunk.citation else chunk.citation,
+                document_name=chunk.citation.partition("|")[0].strip(),
                 page_number=retrieved.page_number if retrieved else None,
                 section=retrieved.section_title if retrieved else None,
-                excerpt=chunk.content[:150] + "..." if len(chunk.content) > 150 else chunk.content,
+                excerpt=chunk.content[:150] + ("..." if len(chunk.content) > 150 else ""),
                 relevance_score=retrieved.final_score if retrieved else 0.0,
                 match_type="direct"
-            ))
+            )
+            for chunk, retrieved in (
+                (c, retrieved_by_id.get(c.chunk_id)) for c in context_chunks[:request.top_k]
+            )
+        ]
         
         query_record.chunks_used = len(sources_used)
         
         # Store answer
         answer_record = Answer(
+            id=str(uuid.uuid4()),
             query_id=query_record.id,
             answer_text=llm_response.text,
-            source_chunks=json.dumps([{
+            source_chunks=[{
                 "chunk_id": c.chunk_id,
                 "citation": c.citation
-            } for c in context_chunks]),
+            } for c in context_chunks],
             overall_confidence=validation_result.grounding_score,
             grounding_confidence=validation_result.grounding_score,
             is_valid=validation_result.is_valid,
             model_used=llm_response.model
         )
-        db.add(answer_record)
-        db.commit()
+        links = [
+            AnswerChunkLink(
+                answer_id=answer_record.id,
+                chunk_id=chunk_id,
+                sentence_index=i,
+                sentence_text=result.sentence,
+                matched_excerpt=excerpt,
+                similarity_score=result.confidence,
+                match_type=result.match_type
+            )
+            for i, result in enumerate(validation_result.sentence_results)
+            for chunk_id, excerpt in zip(result.matched_chunks, result.matched_excerpts)
+        ]
+        background.add_task(_persist_analytics, query_record, answer_record, links)
         
         total_time = int((time.time() - start_time) * 1000)
         
-        return AnswerResponse(
+        return negotiate(http_request, AnswerResponse(
             answer=llm_response.text,
             grounded_sentences=grounded_sentences,
             overall_confidence=validation_result.grounding_score,
@@ -208,7 +249,7 @@ async def ask_question(
             query_id=query_record.id,
             processing_time_ms=total_time,
             model_used=llm_response.model
-        )
+        ))
     
     except ConnectionError as e:
         raise HTTPException(
@@ -223,6 +264,7 @@ async def ask_question(
 @router.post("/extractive", response_model=AnswerResponse | NoAnswerResponse)
 async def ask_extractive(
     request: QueryRequest,
+    http_request: Request,
     db: Session = Depends(get_db_dependency)
 ):
     """
@@ -242,11 +284,11 @@ async def ask_extractive(
     )
     
     if not chunks:
-        return NoAnswerResponse(
+        return negotiate(http_request, NoAnswerResponse(
             reason="No relevant documents found",
             suggestions=["Upload relevant documents"],
             sources_checked=0
-        )
+        ))
     
     # Build context
     context_service = ContextService()
@@ -260,11 +302,11 @@ async def ask_extractive(
     )
     
     if not result["found"]:
-        return NoAnswerResponse(
+        return negotiate(http_request, NoAnswerResponse(
             reason="No extractable answer found in sources",
             suggestions=["The information may not be in the documents"],
             sources_checked=len(chunks)
-        )
+        ))
     
     # Build grounded sentences from verified quotes
     grounded_sentences = []
@@ -285,7 +327,7 @@ async def ask_extractive(
     all_verified = result["all_verified"]
     total_time = int((time.time() - start_time) * 1000)
     
-    return AnswerResponse(
+    return negotiate(http_request, AnswerResponse(
         answer=result["answer"],
         grounded_sentences=grounded_sentences,
         overall_confidence=1.0 if all_verified else 0.7,
@@ -297,7 +339,7 @@ async def ask_extractive(
         query_id="",
         processing_time_ms=total_time,
         model_used=extractive_llm.model
-    )
+    ))
 
 
 @router.post("/stream")
@@ -310,12 +352,14 @@ async def ask_streaming(
     Note: Validation happens after full response.
     """
     # Retrieval
+    query_embedding = await query_batcher.embed(request.question)
     retrieval_service = RetrievalService(db)
     chunks = retrieval_service.retrieve(
         query=request.question,
         document_ids=request.document_ids,
         categories=request.categories,
-        top_k=request.top_k
+        top_k=request.top_k,
+        query_embedding=query_embedding
     )
     
     if not chunks:
@@ -330,11 +374,11 @@ async def ask_streaming(
         full_response = ""
         async for token in llm_service.generate_stream(prompt):
             full_response += token
-            yield f"data: {json.dumps({'token': token})}\n\n"
+            yield b"data: " + orjson.dumps({"token": token}) + b"\n\n"
         
         # Validate at end
         validation = validation_service.validate_answer(full_response, context_chunks)
-        yield f"data: {json.dumps({'done': True, 'grounding_score': validation.grounding_score})}\n\n"
+        yield b"data: " + orjson.dumps({"done": True, "grounding_score": validation.grounding_score}) + b"\n\n"
     
     return StreamingResponse(generate(), media_type="text/event-stream")
 
@@ -342,9 +386,10 @@ async def ask_streaming(
 @router.get("/stats")
 async def query_stats(db: Session = Depends(get_db_dependency)):
     """Get query analytics"""
-    total_queries = db.query(Query).count()
-    grounded_queries = db.query(Query).filter(Query.is_grounded == True).count()
-    avg_grounding = db.query(func.avg(Query.grounding_score)).scalar() or 0
+    stats = db.query(QueryStats).filter(QueryStats.id == 1).first()
+    total_queries = stats.total_queries if stats else 0
+    grounded_queries = stats.grounded_queries if stats else 0
+    avg_grounding = stats.grounding_score_sum / total_queries if total_queries > 0 else 0
     
     return {
         "total_queries": total_queries,
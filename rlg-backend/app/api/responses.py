@@ -0,0 +1,27 @@
+"""
+Response helpers - msgpack content negotiation for answer payloads
+"""
+from fastapi import Request, Response
+from pydantic import BaseModel
+import ormsgpack
+
+
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+
+
+class MsgpackResponse(Response):
+    """Binary msgpack body; smaller and faster to encode than JSON for nested answers"""
+    media_type = MSGPACK_MEDIA_TYPE
+    
+    def render(self, content) -> bytes:
+        return ormsgpack.packb(content, option=ormsgpack.OPT_SERIALIZE_PYDANTIC)
+
+
+def negotiate(request: Request, payload: BaseModel):
+    """
+    Return payload as msgpack if the client sent `Accept: application/x-msgpack`.
+    Otherwise the model is returned unchanged for FastAPI's usual JSON response.
+    """
+    if MSGPACK_MEDIA_TYPE in request.headers.get("accept", ""):
+        return MsgpackResponse(payload)
+    return payload
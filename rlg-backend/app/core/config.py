@@ -24,19 +24,41 @@ class Settings(BaseSettings):
     UPLOAD_DIR: Path = DATA_DIR / "uploads"
     INDEX_DIR: Path = DATA_DIR / "indices"
     CACHE_DIR: Path = DATA_DIR / "cache"
+    # tiktoken BPE files; never downloaded at runtime (see README)
+    TIKTOKEN_CACHE_DIR: Path = CACHE_DIR / "tiktoken"
     
     # Database (SQLite for offline)
     DATABASE_URL: str = f"sqlite:///{DATA_DIR}/rlg.db"
+    DB_POOL_SIZE: int = 8
+    DB_MAX_OVERFLOW: int = 16
     
     # Local Embedding Model
     EMBEDDING_MODEL: str = "sentence-transformers/all-MiniLM-L6-v2"
     EMBEDDING_DIMENSION: int = 384
     EMBEDDING_BATCH_SIZE: int = 32
+    EMBEDDING_DEVICE: Optional[str] = None  # None = CUDA when available, else CPU
+    EMBEDDING_PRECISION: str = "fp16"       # "fp16" (GPU only), "fp32", or "int8" (ONNX Runtime, CPU)
+    EMBEDDING_MAX_SEQ_LENGTH: int = 256     # Token limit for the ONNX encoder
+    VECTOR_STORAGE: str = "fp16"  # "fp16" (half-size), "int8" (quarter-size), or "fp32" (exact)
+    VECTOR_INT8_MIN_VECTORS: int = 10_000  # "int8" stays fp16 until this many vectors to train on
+    VECTOR_INDEX_TYPE: str = "auto"  # "flat" (exact scan), "hnsw" (ANN), or "auto" (flat, then hnsw)
+    HNSW_AUTO_THRESHOLD: int = 10_000  # "auto" rebuilds as HNSW on the first flush past this many vectors
+    HNSW_M: int = 32                 # Graph neighbours per node
+    HNSW_EF_CONSTRUCTION: int = 200
+    HNSW_EF_SEARCH: int = 128        # Search breadth; must be >= the k searched for
+    VECTOR_INDEX_MMAP: bool = True   # Memory-map the saved index instead of reading it into RAM
+    VECTOR_GPU_BATCH_THRESHOLD: int = 32  # Batched searches this large use a GPU copy, if any
+    EMBEDDING_CACHE_SIZE: int = 10000  # In-memory LRU entries
+    EMBEDDING_DISK_CACHE_MAX_ROWS: int = 200000  # Disk cache cap (~1.5 KB/row at 384 dims); compacted to half when full
     
     # Local LLM via Ollama
     OLLAMA_HOST: str = "http://localhost:11434"
     OLLAMA_MODEL: str = "mistral"  # or llama3, phi3, etc.
     OLLAMA_TIMEOUT: int = 120
+    OLLAMA_MAX_CONNECTIONS: int = 16  # Keep-alive pool for async requests
+    OLLAMA_CONNECT_TIMEOUT: float = 1.0  # Local daemon; fail fast if it's down
+    OLLAMA_BREAKER_THRESHOLD: int = 3  # Consecutive connection failures before failing fast
+    OLLAMA_BREAKER_COOLDOWN: float = 10.0  # Seconds to fail fast before probing again
     
     # Retrieval Settings
     BM25_WEIGHT: float = 0.3
@@ -46,10 +68,21 @@ class Settings(BaseSettings):
     TOP_K_RETRIEVAL: int = 20  # Initial retrieval
     TOP_K_RERANK: int = 5      # After reranking
     
+    # Query embeddings from concurrent requests are embedded together
+    QUERY_BATCH_SIZE: int = 8
+    QUERY_BATCH_WAIT_MS: int = 50
+    
     # Chunking Settings
     CHUNK_SIZE: int = 512
     CHUNK_OVERLAP: int = 50
     
+    # Ingestion Pipeline
+    INGEST_QUEUE_SIZE: int = 8        # Bound on each stage queue (backpressure)
+    INGEST_TRANSFORM_WORKERS: int = 2  # Parallel parse/chunk workers
+    FILE_HASH_FILTER_CAPACITY: int = 100_000  # Bloom filter size for upload dedup
+    PDF_EXTRACT_WORKERS: Optional[int] = None  # Processes for PDF text extraction (None = CPU count)
+    PDF_PARALLEL_MIN_PAGES: int = 16  # Smaller PDFs are extracted in-process
+    
     # Grounding Settings
     MIN_GROUNDING_CONFIDENCE: float = 0.7
     REQUIRE_EXACT_CITATION: bool = True
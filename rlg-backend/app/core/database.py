@@ -2,16 +2,29 @@
 Database configuration - SQLite for offline-first operation with FTS5
 """
 from sqlalchemy import create_engine, event, text
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.types import TypeDecorator, BINARY, Text
+from sqlalchemy.dialects.postgresql import UUID as PG_UUID, JSONB
 from contextlib import contextmanager
+from pathlib import Path
+import uuid
+import orjson
+from blake3 import blake3
 
 from app.core.config import settings
 
 
-# SQLite engine with FTS5 support
+# SQLite engine with FTS5 support.
+# Pooled connections are reused across requests, so the PRAGMA setup below
+# runs once per connection rather than once per request. WAL lets the
+# pooled readers proceed while a writer holds the lock.
 engine = create_engine(
     settings.DATABASE_URL,
     connect_args={"check_same_thread": False},  # SQLite specific
+    poolclass=QueuePool,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
     echo=settings.DEBUG
 )
 
@@ -25,6 +38,9 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor.execute("PRAGMA synchronous=NORMAL")
     cursor.execute("PRAGMA cache_size=10000")
     cursor.execute("PRAGMA temp_store=MEMORY")
+    # Serve reads straight from the page cache via mmap (256 MiB window)
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA wal_autocheckpoint=1000")
     cursor.close()
 
 
@@ -32,6 +48,58 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 
+class GUID(TypeDecorator):
+    """
+    UUID key stored as 16 raw bytes (native UUID on PostgreSQL) instead of
+    a 36-char string, so PK/FK indexes are less than half the size.
+    Python-side values stay canonical UUID strings.
+    """
+    impl = BINARY(16)
+    cache_ok = True
+    
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            return dialect.type_descriptor(PG_UUID(as_uuid=False))
+        return dialect.type_descriptor(BINARY(16))
+    
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name == "postgresql":
+            return value
+        try:
+            return uuid.UUID(str(value)).bytes
+        except ValueError:
+            return str(value).encode()  # Not a UUID, so it matches nothing
+    
+    def process_result_value(self, value, dialect):
+        if isinstance(value, bytes):
+            return str(uuid.UUID(bytes=value))
+        return value
+
+
+class JSONText(TypeDecorator):
+    """
+    JSON value column: JSONB on PostgreSQL, compact orjson-encoded TEXT
+    elsewhere. Python-side values are plain lists/dicts.
+    """
+    impl = Text
+    cache_ok = True
+    
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            return dialect.type_descriptor(JSONB())
+        return dialect.type_descriptor(Text())
+    
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name == "postgresql":
+            return value
+        return orjson.dumps(value).decode()
+    
+    def process_result_value(self, value, dialect):
+        if isinstance(value, (str, bytes)):
+            return orjson.loads(value)
+        return value
+
+
 @contextmanager
 def get_db():
     """Dependency for database sessions"""
@@ -54,15 +122,170 @@ def get_db_dependency():
 def init_db():
     """Initialize database tables and FTS5 virtual tables"""
     from app.models import document, chunk, query, answer  # Import all models
+    
+    # Larger pages mean shallower B-trees for chunk text. page_size can only
+    # change on a brand-new database, and not while it is in WAL mode, so
+    # drop out of WAL just for the VACUUM that applies it.
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        has_tables = conn.execute(text("SELECT count(*) FROM sqlite_master")).scalar()
+        if not has_tables:
+            conn.execute(text("PRAGMA journal_mode=DELETE"))
+            conn.execute(text("PRAGMA page_size=8192"))
+            conn.execute(text("VACUUM"))
+            conn.execute(text("PRAGMA journal_mode=WAL"))
+    
     Base.metadata.create_all(bind=engine)
+    _migrate_uuid_keys()
+    _migrate_blake3_hashes()
+    
+    # Seed the query_stats summary row, from existing queries on upgrade
+    with engine.connect() as conn:
+        conn.execute(text("""
+            INSERT OR IGNORE INTO query_stats (id, total_queries, grounded_queries, grounding_score_sum)
+            SELECT 1, count(*), coalesce(sum(is_grounded), 0), coalesce(sum(grounding_score), 0.0)
+            FROM queries
+        """))
+        conn.commit()
     
-    # Create FTS5 virtual table for full-text search
+    # FTS5 index over chunks.content. External-content table: FTS5 keeps
+    # only the inverted index and reads the text from `chunks` by key, so
+    # chunk text is stored once. prefix='2 3 4' indexes 2-4 character
+    # prefixes so `term*` queries are index lookups rather than scans.
+    # The key is chunks.fts_rowid, not the implicit rowid: chunks has a
+    # GUID primary key, so VACUUM may renumber its rowids.
     with engine.connect() as conn:
+        existing = conn.execute(text(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'chunks_fts'"
+        )).scalar()
+        # Older databases kept a second copy of the text in chunks_fts,
+        # lack the prefix indexes, or key it on rowid; recreate and rebuild
+        needs_rebuild = bool(existing) and "content_rowid='fts_rowid'" not in existing
+        if needs_rebuild:
+            for trigger in ("chunks_ai", "chunks_ad", "chunks_au"):
+                conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+            conn.execute(text("DROP TABLE chunks_fts"))
+        
+        columns = [row[1] for row in conn.execute(text("PRAGMA table_info(chunks)"))]
+        if "fts_rowid" not in columns:
+            conn.execute(text("ALTER TABLE chunks ADD COLUMN fts_rowid INTEGER"))
+            conn.execute(text("UPDATE chunks SET fts_rowid = rowid"))
+        conn.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_chunk_fts_rowid ON chunks (fts_rowid)"
+        ))
+        
         conn.execute(text("""
             CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(
                 content,
-                chunk_id UNINDEXED,
-                tokenize='porter unicode61'
+                content='chunks',
+                content_rowid='fts_rowid',
+                tokenize='porter unicode61',
+                prefix='2 3 4'
             )
         """))
+        
+        # Keep chunks_fts in sync with chunks inside SQLite itself, so
+        # ingestion and deletes never issue FTS statements. Inserts take
+        # the next fts_rowid here, inside the write transaction, so
+        # concurrent writers can't pick the same one.
+        conn.execute(text("""
+            CREATE TRIGGER IF NOT EXISTS chunks_ai AFTER INSERT ON chunks BEGIN
+                UPDATE chunks SET fts_rowid = (
+                    SELECT coalesce(max(fts_rowid), 0) + 1 FROM chunks
+                ) WHERE rowid = new.rowid AND fts_rowid IS NULL;
+                INSERT INTO chunks_fts (rowid, content)
+                    SELECT fts_rowid, content FROM chunks WHERE rowid = new.rowid;
+            END
+        """))
+        conn.execute(text("""
+            CREATE TRIGGER IF NOT EXISTS chunks_ad AFTER DELETE ON chunks BEGIN
+                INSERT INTO chunks_fts (chunks_fts, rowid, content) VALUES ('delete', old.fts_rowid, old.content);
+            END
+        """))
+        conn.execute(text("""
+            CREATE TRIGGER IF NOT EXISTS chunks_au AFTER UPDATE OF content ON chunks BEGIN
+                INSERT INTO chunks_fts (chunks_fts, rowid, content) VALUES ('delete', old.fts_rowid, old.content);
+                INSERT INTO chunks_fts (rowid, content) VALUES (new.fts_rowid, new.content);
+            END
+        """))
+        
+        if needs_rebuild:
+            conn.execute(text("INSERT INTO chunks_fts (chunks_fts) VALUES ('rebuild')"))
+        conn.commit()
+
+
+# Key columns converted from String(36) to GUID
+UUID_KEY_COLUMNS = {
+    "documents": ("id",),
+    "chunks": ("id", "document_id"),
+    "queries": ("id",),
+    "answers": ("id", "query_id"),
+    "answer_chunk_links": ("id", "answer_id", "chunk_id"),
+}
+
+
+def _migrate_uuid_keys():
+    """
+    Convert keys written by older versions as 36-char text to 16-byte
+    blobs. SQLite columns are dynamically typed, so the existing tables
+    accept blobs without being rebuilt.
+    """
+    with engine.connect() as conn:
+        legacy = conn.execute(text(
+            "SELECT 1 FROM documents WHERE typeof(id) = 'text' "
+            "UNION ALL SELECT 1 FROM queries WHERE typeof(id) = 'text' LIMIT 1"
+        )).first()
+        if not legacy:
+            return
+        
+        conn.connection.driver_connection.create_function(
+            "uuid_blob", 1,
+            lambda v: uuid.UUID(v).bytes if isinstance(v, str) else v,
+            deterministic=True
+        )
+        for table, columns in UUID_KEY_COLUMNS.items():
+            assignments = ", ".join(f"{c} = uuid_blob({c})" for c in columns)
+            conn.execute(text(f"UPDATE {table} SET {assignments}"))
+        conn.commit()
+
+
+# PRAGMA user_version once file and chunk hashes are BLAKE3
+BLAKE3_HASH_VERSION = 1
+
+
+def blake3_hashes_migrated(db) -> bool:
+    """False until _migrate_blake3_hashes() has run on this database"""
+    return db.execute(text("PRAGMA user_version")).scalar() >= BLAKE3_HASH_VERSION
+
+
+def _migrate_blake3_hashes():
+    """
+    Rehash file and chunk hashes written by older versions with SHA-256,
+    so re-uploads and repeated chunks still match them. Both formats are
+    hex of the same length, so the database version marks the switch.
+    Documents whose file is gone keep their old hash.
+    """
+    from app.services.ingestion_service import compute_file_hash
+    
+    def file_hash(filepath):
+        try:
+            return compute_file_hash(Path(filepath))
+        except OSError:
+            return None
+    
+    with engine.connect() as conn:
+        if blake3_hashes_migrated(conn):
+            return
+        
+        driver = conn.connection.driver_connection
+        driver.create_function(
+            "blake3_content", 1,
+            lambda v: blake3(v.encode()).hexdigest(length=16) if v is not None else None,
+            deterministic=True
+        )
+        driver.create_function("blake3_file", 1, file_hash)
+        conn.execute(text("UPDATE chunks SET content_hash = blake3_content(content)"))
+        conn.execute(text(
+            "UPDATE documents SET file_hash = coalesce(blake3_file(filepath), file_hash)"
+        ))
+        conn.execute(text(f"PRAGMA user_version = {BLAKE3_HASH_VERSION}"))
         conn.commit()
@@ -5,6 +5,8 @@ A grounded Q&A system that's better than RAG
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+import asyncio
+import time
 
 from app.core.config import settings
 from app.core.database import init_db
@@ -19,9 +21,23 @@ async def lifespan(app: FastAPI):
     init_db()
     print("✓ Database initialized")
     
+    from app.services.ingestion_pipeline import ingestion_pipeline
+    await ingestion_pipeline.start()
+    print("✓ Ingestion pipeline started")
+    
+    from app.services.query_batcher import query_batcher
+    await query_batcher.start()
+    
+    # Pay first-call costs (model kernels, index pages) before serving
+    from app.services.embedding_service import embedding_service
+    from app.services.vector_index_service import vector_index
+    await asyncio.to_thread(embedding_service.warmup)
+    await asyncio.to_thread(vector_index.warmup)
+    print("✓ Embedding model and vector index warmed up")
+    
     # Check Ollama
     from app.services.llm_service import llm_service
-    if llm_service.is_available():
+    if await llm_service.is_available_async():
         models = llm_service.get_available_models()
         print(f"✓ Ollama connected. Available models: {models}")
     else:
@@ -31,6 +47,9 @@ async def lifespan(app: FastAPI):
     
     # Shutdown
     print("👋 Shutting down RLG Engine...")
+    await ingestion_pipeline.stop()
+    await query_batcher.stop()
+    await llm_service.aclose()
 
 
 app = FastAPI(
@@ -75,21 +94,38 @@ app.include_router(documents.router, prefix="/documents")
 app.include_router(query.router, prefix="/query")
 
 
+# System info is cached briefly so frequent polling doesn't probe Ollama
+# on every request
+HEALTH_CACHE_TTL = 5.0
+_health_cache: tuple[float, dict] = (0.0, {})
+
+
 @app.get("/")
 async def root():
     """Health check and system info"""
+    global _health_cache
     from app.services.llm_service import llm_service
     from app.services.vector_index_service import vector_index
     
-    return {
+    cached_at, info = _health_cache
+    if time.monotonic() - cached_at < HEALTH_CACHE_TTL:
+        return info
+    
+    llm_available, index_stats = await asyncio.gather(
+        llm_service.is_available_async(),
+        asyncio.to_thread(vector_index.get_stats)
+    )
+    info = {
         "name": "RLG Engine",
         "version": settings.APP_VERSION,
         "status": "running",
-        "llm_available": llm_service.is_available(),
+        "llm_available": llm_available,
         "llm_model": settings.OLLAMA_MODEL,
         "embedding_model": settings.EMBEDDING_MODEL,
-        "vector_index": vector_index.get_stats()
+        "vector_index": index_stats
     }
+    _health_cache = (time.monotonic(), info)
+    return info
 
 
 @app.get("/health")
@@ -6,7 +6,7 @@ from sqlalchemy.orm import relationship
 from datetime import datetime
 import uuid
 
-from app.core.database import Base
+from app.core.database import Base, GUID, JSONText
 
 
 class Answer(Base):
@@ -16,14 +16,14 @@ class Answer(Base):
     """
     __tablename__ = "answers"
     
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    query_id = Column(String(36), ForeignKey("queries.id", ondelete="CASCADE"), nullable=False)
+    id = Column(GUID(), primary_key=True, default=lambda: str(uuid.uuid4()))
+    query_id = Column(GUID(), ForeignKey("queries.id", ondelete="CASCADE"), nullable=False)
     
     # Response content
     answer_text = Column(Text, nullable=False)
     
     # Grounding evidence (JSON array of chunk references)
-    source_chunks = Column(Text, nullable=False)  # JSON: [{chunk_id, relevance, excerpt}]
+    source_chunks = Column(JSONText(), nullable=False)  # [{chunk_id, relevance, excerpt}]
     
     # Confidence metrics
     overall_confidence = Column(Float, default=0.0)  # 0-1
@@ -53,9 +53,9 @@ class AnswerChunkLink(Base):
     """
     __tablename__ = "answer_chunk_links"
     
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    answer_id = Column(String(36), ForeignKey("answers.id", ondelete="CASCADE"), nullable=False)
-    chunk_id = Column(String(36), ForeignKey("chunks.id", ondelete="CASCADE"), nullable=False)
+    id = Column(GUID(), primary_key=True, default=lambda: str(uuid.uuid4()))
+    answer_id = Column(GUID(), ForeignKey("answers.id", ondelete="CASCADE"), nullable=False)
+    chunk_id = Column(GUID(), ForeignKey("chunks.id", ondelete="CASCADE"), nullable=False)
     
     # Which sentence in the answer
     sentence_index = Column(Integer, default=0)
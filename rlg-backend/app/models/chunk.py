@@ -2,13 +2,15 @@
 Chunk model - represents text segments for retrieval
 Enhanced with structural metadata for better grounding
 """
-from sqlalchemy import Column, String, Text, Integer, Float, ForeignKey, DateTime, Boolean
+from sqlalchemy import Column, String, Text, Integer, Float, ForeignKey, DateTime, Boolean, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
+from functools import lru_cache
+from typing import Optional
 import uuid
 import enum
 
-from app.core.database import Base
+from app.core.database import Base, GUID, JSONText
 
 
 class ChunkType(enum.Enum):
@@ -30,12 +32,15 @@ class Chunk(Base):
     """
     __tablename__ = "chunks"
     
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    document_id = Column(String(36), ForeignKey("documents.id", ondelete="CASCADE"), nullable=False)
+    id = Column(GUID(), primary_key=True, default=lambda: str(uuid.uuid4()))
+    document_id = Column(GUID(), ForeignKey("documents.id", ondelete="CASCADE"), nullable=False)
     
     # Content
     content = Column(Text, nullable=False)
-    content_hash = Column(String(64))  # For deduplication
+    content_hash = Column(String(64))  # BLAKE3 prefix, for deduplication
+    # Stable integer key for chunks_fts, assigned by the chunks_ai trigger.
+    # Unlike the implicit rowid, VACUUM never renumbers it
+    fts_rowid = Column(Integer, nullable=True)
     
     # Position for citation
     page_number = Column(Integer, nullable=True)
@@ -55,7 +60,7 @@ class Chunk(Base):
     information_density = Column(Float, default=1.0)  # Computed from term frequency
     
     # Entity extraction cache (for graph-based retrieval)
-    entities = Column(Text, nullable=True)  # JSON: [{type, value, positions}]
+    entities = Column(JSONText(), nullable=True)  # [{type, value, positions}]
     
     # Sequence for context window
     sequence_index = Column(Integer, default=0)  # Order in document
@@ -66,16 +71,43 @@ class Chunk(Base):
     # Relationships
     document = relationship("Document", back_populates="chunks")
     
+    # Ordered range scans per document (chunk listing, context windows)
+    __table_args__ = (
+        Index("ix_chunk_doc_seq", "document_id", "sequence_index"),
+        Index("ix_chunk_fts_rowid", "fts_rowid", unique=True),
+    )
+    
     def __repr__(self):
         return f"<Chunk(id={self.id}, page={self.page_number}, type={self.chunk_type})>"
     
     def get_citation(self) -> str:
         """Generate a formatted citation for this chunk"""
-        parts = []
-        if self.document:
-            parts.append(self.document.filename)
-        if self.page_number:
-            parts.append(f"p.{self.page_number}")
-        if self.section_title:
-            parts.append(f"§{self.section_title}")
-        return " | ".join(parts) if parts else f"Chunk {self.id[:8]}"
+        citation = format_citation(
+            self.document.filename if self.document else None,
+            self.page_number,
+            self.section_title
+        )
+        return citation or f"Chunk {self.id[:8]}"
+
+
+CITATION_SEPARATOR = " | "
+
+
+@lru_cache(maxsize=4096)
+def format_citation(
+    document_name: Optional[str],
+    page_number: Optional[int],
+    section_title: Optional[str]
+) -> str:
+    """
+    "document | p.N | §Section" citation text ("" if all parts are empty).
+    Cached because chunks of the same document repeat the same citation.
+    """
+    parts = []
+    if document_name:
+        parts.append(document_name)
+    if page_number:
+        parts.append(f"p.{page_number}")
+    if section_title:
+        parts.append(f"§{section_title}")
+    return CITATION_SEPARATOR.join(parts)
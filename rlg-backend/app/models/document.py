@@ -1,13 +1,13 @@
 """
 Document model - represents uploaded source files
 """
-from sqlalchemy import Column, String, Text, Integer, DateTime, Enum, Float
+from sqlalchemy import Column, String, Text, Integer, DateTime, Enum, Float, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 import uuid
 import enum
 
-from app.core.database import Base
+from app.core.database import Base, GUID
 
 
 class DocumentStatus(enum.Enum):
@@ -34,14 +34,14 @@ class Document(Base):
     """
     __tablename__ = "documents"
     
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(GUID(), primary_key=True, default=lambda: str(uuid.uuid4()))
     
     # File info
     filename = Column(String(512), nullable=False)
     filepath = Column(String(1024), nullable=False)
     file_type = Column(Enum(DocumentType), nullable=False)
     file_size = Column(Integer)  # bytes
-    file_hash = Column(String(64))  # SHA-256 for deduplication
+    file_hash = Column(String(64))  # BLAKE3 hex for deduplication
     
     # Processing status
     status = Column(Enum(DocumentStatus), default=DocumentStatus.PENDING)
@@ -69,5 +69,14 @@ class Document(Base):
     # Relationships
     chunks = relationship("Chunk", back_populates="document", cascade="all, delete-orphan")
     
+    # Filtered, newest-first listing (list_documents)
+    __table_args__ = (
+        # id breaks created_at ties for the (created_at, id) keyset cursor
+        Index("ix_doc_status_created_id", "status", "created_at", "id"),
+        Index("ix_doc_category_created_id", "category", "created_at", "id"),
+        Index("ix_doc_created_id", "created_at", "id"),
+        Index("ix_doc_file_hash", "file_hash"),  # Duplicate check on upload
+    )
+    
     def __repr__(self):
         return f"<Document(id={self.id}, filename='{self.filename}', status={self.status})>"
@@ -5,7 +5,7 @@ from sqlalchemy import Column, String, Text, Integer, Float, DateTime, Boolean
 from datetime import datetime
 import uuid
 
-from app.core.database import Base
+from app.core.database import Base, GUID, JSONText
 
 
 class Query(Base):
@@ -15,7 +15,7 @@ class Query(Base):
     """
     __tablename__ = "queries"
     
-    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(GUID(), primary_key=True, default=lambda: str(uuid.uuid4()))
     
     # Query content
     question = Column(Text, nullable=False)
@@ -23,7 +23,7 @@ class Query(Base):
     
     # Query analysis
     query_type = Column(String(32))  # factual, procedural, comparative, etc.
-    detected_entities = Column(Text)  # JSON: entities mentioned in query
+    detected_entities = Column(JSONText())  # Entities mentioned in query
     
     # Retrieval metrics
     retrieval_time_ms = Column(Integer)
@@ -52,3 +52,25 @@ class Query(Base):
     
     def __repr__(self):
         return f"<Query(id={self.id[:8]}, grounded={self.is_grounded})>"
+
+
+class QueryStats(Base):
+    """
+    Single-row running totals over committed queries.
+    Lets the /stats dashboard read one row instead of scanning `queries`.
+    """
+    __tablename__ = "query_stats"
+    
+    id = Column(Integer, primary_key=True, default=1)
+    total_queries = Column(Integer, default=0, nullable=False)
+    grounded_queries = Column(Integer, default=0, nullable=False)
+    grounding_score_sum = Column(Float, default=0.0, nullable=False)
+    
+    @classmethod
+    def record(cls, db, query: Query):
+        """Atomically add a finished query to the totals (same transaction as the query)"""
+        db.query(cls).filter(cls.id == 1).update({
+            cls.total_queries: cls.total_queries + 1,
+            cls.grounded_queries: cls.grounded_queries + (1 if query.is_grounded else 0),
+            cls.grounding_score_sum: cls.grounding_score_sum + (query.grounding_score or 0.0)
+        }, synchronize_session=False)
@@ -1,7 +1,7 @@
 """
 Document schemas for API requests/responses
 """
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from typing import Optional, List
 from datetime import datetime
 from enum import Enum
@@ -52,6 +52,20 @@ class DocumentResponse(BaseModel):
     
     class Config:
         from_attributes = True
+    
+    @field_validator("file_type", "status", mode="before")
+    @classmethod
+    def unwrap_model_enum(cls, v):
+        """Accept the ORM's DocumentType/DocumentStatus members"""
+        return getattr(v, "value", v)
+    
+    @field_validator("tags", mode="before")
+    @classmethod
+    def split_tags(cls, v):
+        """Tags are stored comma-separated on the Document row"""
+        if isinstance(v, str):
+            return v.split(",") if v else None
+        return v
 
 
 class DocumentListResponse(BaseModel):
@@ -60,6 +74,7 @@ class DocumentListResponse(BaseModel):
     total: int
     page: int
     page_size: int
+    next_cursor: Optional[str] = None  # "created_at,id"; pass as ?cursor= for the next page
 
 
 class ChunkResponse(BaseModel):
@@ -4,10 +4,32 @@ Includes citation markers and structure preservation
 """
 from typing import List, Optional
 from dataclasses import dataclass
-import re
 
-from app.services.retrieval_service import RetrievedChunk
+from app.models.chunk import format_citation
+from app.services.retrieval_service import RetrievedChunk, top_k_by_score
 from app.core.config import settings
+from app.utils.tokenizer import estimate_tokens
+
+
+# Grounded QA prompt. Only the three slots vary per request, so the
+# static rules are defined once rather than rebuilt as an f-string.
+GROUNDED_PROMPT = """You are a precise question-answering assistant. Your answers MUST be grounded in the provided sources.
+
+STRICT RULES:
+1. ONLY use information from the REFERENCE SOURCES below
+2. ALWAYS cite sources using the citation markers [1], [2], etc.
+3. If information is not in the sources, say "I cannot find this information in the provided sources"
+4. NEVER make up facts or use external knowledge
+5. Quote exact phrases when possible to maintain accuracy
+
+{context}
+
+CITATION KEY:
+{citations}
+
+QUESTION: {question}
+
+ANSWER (with citations):"""
 
 
 @dataclass
@@ -43,11 +65,13 @@ class ContextService:
         if not chunks:
             return "", []
         
-        # Deduplicate by content hash
+        # Deduplicate on the full content: the hash stored at ingestion
+        # when present, otherwise the content itself (str hashes are cached,
+        # so no substring is built per chunk)
         seen_content = set()
         unique_chunks = []
         for chunk in chunks:
-            content_key = chunk.content[:100]  # First 100 chars as key
+            content_key = chunk.content_hash or chunk.content
             if content_key not in seen_content:
                 seen_content.add(content_key)
                 unique_chunks.append(chunk)
@@ -55,27 +79,23 @@ class ContextService:
         # Build context with citation markers
         context_chunks = []
         context_parts = []
+        context_tokens = 0  # Running token count of context_parts
         
         for i, chunk in enumerate(unique_chunks, 1):
             marker = f"[{i}]"
             
-            # Build citation string
-            citation_parts = [chunk.document_name]
-            if chunk.page_number:
-                citation_parts.append(f"p.{chunk.page_number}")
-            if chunk.section_title:
-                citation_parts.append(f"§{chunk.section_title}")
-            citation = " | ".join(citation_parts)
+            citation = format_citation(chunk.document_name, chunk.page_number, chunk.section_title)
             
             # Format for context
             formatted = f"{marker} {chunk.content}"
             
-            # Check token budget (rough estimate: 4 chars per token)
-            estimated_tokens = sum(len(p) for p in context_parts) // 4
-            if estimated_tokens + len(formatted) // 4 > self.max_tokens:
+            # Check token budget
+            formatted_tokens = estimate_tokens(formatted)
+            if context_tokens + formatted_tokens > self.max_tokens:
                 break
             
             context_parts.append(formatted)
+            context_tokens += formatted_tokens
             context_chunks.append(ContextChunk(
                 marker=marker,
                 content=chunk.content,
@@ -99,42 +119,40 @@ class ContextService:
         Build a prompt that enforces grounded responses.
         Key to preventing hallucination.
         """
-        citation_guide = "\n".join([
-            f"{c.marker} = {c.citation}" for c in context_chunks
-        ])
-        
-        prompt = f"""You are a precise question-answering assistant. Your answers MUST be grounded in the provided sources.
-
-STRICT RULES:
-1. ONLY use information from the REFERENCE SOURCES below
-2. ALWAYS cite sources using the citation markers [1], [2], etc.
-3. If information is not in the sources, say "I cannot find this information in the provided sources"
-4. NEVER make up facts or use external knowledge
-5. Quote exact phrases when possible to maintain accuracy
-
-{context}
-
-CITATION KEY:
-{citation_guide}
-
-QUESTION: {question}
-
-ANSWER (with citations):"""
-        
-        return prompt
+        citations = "\n".join(f"{c.marker} = {c.citation}" for c in context_chunks)
+        return GROUNDED_PROMPT.format(context=context, citations=citations, question=question)
     
     def expand_context_window(
         self,
         chunks: List[RetrievedChunk],
         db,
-        window_size: int = 1
+        window_size: int = 1,
+        top_k: Optional[int] = None
     ) -> List[RetrievedChunk]:
         """
         Expand context by including adjacent chunks.
         Useful when answers span multiple chunks.
+        Returns all chunks by score, or only the best top_k if given.
         """
+        from sqlalchemy import and_, or_
         from app.models.chunk import Chunk
         
+        # Fetch every window in one query instead of one query per chunk
+        windows = [
+            and_(
+                Chunk.document_id == c.document_id,
+                Chunk.sequence_index.between(
+                    c.sequence_index - window_size,
+                    c.sequence_index + window_size
+                )
+            )
+            for c in chunks if c.sequence_index is not None
+        ]
+        neighbours = {}
+        if windows:
+            for adj in db.query(Chunk).filter(or_(*windows)).order_by(Chunk.sequence_index):
+                neighbours.setdefault(adj.document_id, []).append(adj)
+        
         expanded = []
         seen_ids = set()
         
@@ -144,16 +162,13 @@ ANSWER (with citations):"""
                 expanded.append(chunk)
                 seen_ids.add(chunk.chunk_id)
             
-            # Get adjacent chunks
-            adj_chunks = db.query(Chunk).filter(
-                Chunk.document_id == chunk.document_id,
-                Chunk.sequence_index.between(
-                    chunk.sequence_index - window_size if hasattr(chunk, 'sequence_index') else 0,
-                    chunk.sequence_index + window_size if hasattr(chunk, 'sequence_index') else 0
-                )
-            ).all()
+            if chunk.sequence_index is None:
+                continue
             
-            for adj in adj_chunks:
+            # Adjacent chunks from the same document
+            for adj in neighbours.get(chunk.document_id, []):
+                if abs(adj.sequence_index - chunk.sequence_index) > window_size:
+                    continue
                 if adj.id not in seen_ids:
                     # Create RetrievedChunk from adjacent
                     expanded.append(RetrievedChunk(
@@ -164,10 +179,12 @@ ANSWER (with citations):"""
                         page_number=adj.page_number,
                         section_title=adj.section_title,
                         chunk_type=adj.chunk_type,
+                        sequence_index=adj.sequence_index,
                         final_score=chunk.final_score * 0.5,  # Lower score for adjacent
-                        confidence_weight=adj.confidence_weight
+                        confidence_weight=adj.confidence_weight,
+                        content_hash=adj.content_hash
                     ))
                     seen_ids.add(adj.id)
         
         # Re-sort by score
-        return sorted(expanded, key=lambda x: x.final_score, reverse=True)
+        return top_k_by_score(expanded, top_k)
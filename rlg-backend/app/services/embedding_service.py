@@ -3,95 +3,363 @@ Embedding Service - Local embeddings via sentence-transformers
 100% offline - no API calls required
 """
 import numpy as np
-from typing import List, Optional
+from typing import Dict, List, Optional
+from collections import OrderedDict
 from pathlib import Path
 import hashlib
+from blake3 import blake3
 import json
+import os
+import threading
 
 from app.core.config import settings
 
 
+class EmbeddingCache:
+    """
+    Content-hash -> embedding cache.
+    An in-memory LRU sits in front of an append-only store on disk:
+    embeddings.bin holds float32 rows (read through np.memmap) and
+    embeddings.idx holds the matching 16-byte keys in the same order.
+    The store is capped at max_disk_rows; when full it is compacted to
+    its newest half, so rows of deleted documents age out.
+    """
+    
+    KEY_SIZE = 16
+    
+    def __init__(self, directory: Path, dimension: int, max_memory_items: int, max_disk_rows: int):
+        self.dimension = dimension
+        self.max_memory_items = max_memory_items
+        self.max_disk_rows = max(max_disk_rows, 1)
+        self.bin_path = directory / "embeddings.bin"
+        self.idx_path = directory / "embeddings.idx"
+        
+        self._memory: OrderedDict = OrderedDict()
+        self._rows: Dict[bytes, int] = {}
+        self._n_rows = 0
+        self._store: Optional[np.memmap] = None
+        self._lock = threading.Lock()
+        
+        directory.mkdir(parents=True, exist_ok=True)
+        self._load()
+    
+    def _load(self):
+        """Rebuild the key -> row map from the on-disk store"""
+        if not (self.bin_path.exists() and self.idx_path.exists()):
+            return
+        
+        keys = self.idx_path.read_bytes()
+        # A write interrupted mid-append leaves the files out of step;
+        # only trust rows present in both
+        n_rows = min(
+            len(keys) // self.KEY_SIZE,
+            self.bin_path.stat().st_size // (self.dimension * 4)
+        )
+        self._rows = {
+            keys[i * self.KEY_SIZE:(i + 1) * self.KEY_SIZE]: i for i in range(n_rows)
+        }
+        self._n_rows = n_rows
+        self._remap()
+        if n_rows > self.max_disk_rows:
+            self._compact(self.max_disk_rows // 2)  # Cap lowered since last run
+    
+    def _compact(self, keep: int):
+        """
+        Rewrite the store with only its newest `keep` rows. The key file
+        is removed before the row file is swapped, so a crash part-way
+        leaves an empty cache rather than keys pointing at other rows.
+        """
+        start = self._n_rows - keep
+        keys = self.idx_path.read_bytes()[start * self.KEY_SIZE:self._n_rows * self.KEY_SIZE]
+        bin_tmp = self.bin_path.with_name(self.bin_path.name + ".tmp")
+        idx_tmp = self.idx_path.with_name(self.idx_path.name + ".tmp")
+        if keep:
+            np.asarray(self._store[start:]).tofile(bin_tmp)
+        else:
+            bin_tmp.write_bytes(b"")
+        idx_tmp.write_bytes(keys)
+        
+        self._store = None  # Release the mmap before replacing its file
+        self.idx_path.unlink()
+        os.replace(bin_tmp, self.bin_path)
+        os.replace(idx_tmp, self.idx_path)
+        
+        self._rows = {
+            keys[i * self.KEY_SIZE:(i + 1) * self.KEY_SIZE]: i for i in range(keep)
+        }
+        self._n_rows = keep
+        self._remap()
+    
+    def _remap(self):
+        self._store = np.memmap(
+            self.bin_path, dtype=np.float32, mode="r",
+            shape=(self._n_rows, self.dimension)
+        ) if self._n_rows else None
+    
+    def _remember(self, key: bytes, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+    
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        """Look up an embedding; None on a miss"""
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                return vector
+            
+            row = self._rows.get(key)
+            if row is None:
+                return None
+            vector = np.array(self._store[row])  # Copy out of the mmap
+            self._remember(key, vector)
+            return vector
+    
+    def put_many(self, keys: List[bytes], vectors: np.ndarray):
+        """Store new embeddings in memory and append them to disk"""
+        with self._lock:
+            new = [(k, v) for k, v in zip(keys, vectors) if k not in self._rows]
+            new = new[-self.max_disk_rows:]
+            if self._n_rows + len(new) > self.max_disk_rows:
+                # Compact to half the cap, so this runs once per many puts
+                self._compact(max(self.max_disk_rows // 2 - len(new), 0))
+            if new:
+                # Keys are written last, so a crash never indexes a missing row
+                with open(self.bin_path, "ab") as f:
+                    np.asarray([v for _, v in new], dtype=np.float32).tofile(f)
+                with open(self.idx_path, "ab") as f:
+                    f.write(b"".join(k for k, _ in new))
+                
+                for i, (key, _) in enumerate(new):
+                    self._rows[key] = self._n_rows + i
+                self._n_rows += len(new)
+                self._remap()
+            
+            for key, vector in zip(keys, vectors):
+                self._remember(key, np.asarray(vector, dtype=np.float32))
+
+
+class OnnxEncoder:
+    """
+    SentenceTransformer-compatible encode() on ONNX Runtime with int8
+    dynamic quantization (mean-pooling models such as all-MiniLM).
+    The model is exported and quantized once into CACHE_DIR/models/onnx.
+    """
+    
+    QUANTIZED_FILE = "model_quantized.onnx"
+    
+    def __init__(self, model_name: str, cache_dir: Path, max_seq_length: int):
+        try:
+            from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+            from optimum.onnxruntime.configuration import AutoQuantizationConfig
+            from transformers import AutoTokenizer
+        except ImportError:
+            raise ImportError(
+                "int8 embeddings need ONNX Runtime. Install with: pip install optimum[onnxruntime]"
+            )
+        
+        self.max_seq_length = max_seq_length
+        model_dir = cache_dir / "onnx" / model_name.replace("/", "__")
+        
+        if not (model_dir / self.QUANTIZED_FILE).exists():
+            print(f"Exporting {model_name} to ONNX (int8), first run only...")
+            exported = ORTModelForFeatureExtraction.from_pretrained(
+                model_name, export=True, cache_dir=str(cache_dir)
+            )
+            exported.save_pretrained(model_dir)
+            ORTQuantizer.from_pretrained(exported).quantize(
+                save_dir=model_dir,
+                quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False)
+            )
+            AutoTokenizer.from_pretrained(model_name, cache_dir=str(cache_dir)).save_pretrained(model_dir)
+        
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir, file_name=self.QUANTIZED_FILE
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    
+    def encode(
+        self,
+        sentences,
+        batch_size: int = 32,
+        convert_to_numpy: bool = True,
+        normalize_embeddings: bool = False,
+        show_progress_bar: bool = False
+    ) -> np.ndarray:
+        """Embed one text (1-D result) or a list of texts (2-D result)"""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        
+        parts = []
+        for start in range(0, len(texts), batch_size):
+            tokens = self.tokenizer(
+                texts[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np"
+            )
+            hidden = self.model(**tokens).last_hidden_state
+            
+            # Mean pooling over real (non-padding) tokens
+            mask = tokens["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if normalize_embeddings:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            parts.append(pooled.astype(np.float32))
+        
+        embeddings = np.concatenate(parts) if parts else np.zeros((0, 0), dtype=np.float32)
+        return embeddings[0] if single else embeddings
+
+
 class EmbeddingService:
     """
     Local embedding service using sentence-transformers.
     Runs completely offline with cached models.
+    Use the module-level `embedding_service` instance.
     """
     
-    _instance: Optional["EmbeddingService"] = None
-    _model = None
-    
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-        return cls._instance
-    
     def __init__(self):
-        if self._model is None:
-            self._load_model()
+        self._model = None
+        self.precision = "fp32"
+        self._load_model()
+        # Vectors depend on model and precision, so each pair gets its own cache
+        self._cache = EmbeddingCache(
+            settings.CACHE_DIR / "embeddings"
+            / f"{settings.EMBEDDING_MODEL.replace('/', '__')}__{self.precision}",
+            settings.EMBEDDING_DIMENSION,
+            settings.EMBEDDING_CACHE_SIZE,
+            settings.EMBEDDING_DISK_CACHE_MAX_ROWS
+        )
     
     def _load_model(self):
-        """Load the embedding model (lazy initialization)"""
+        """Load the embedding model"""
+        if settings.EMBEDDING_PRECISION == "int8":
+            self._model = OnnxEncoder(
+                settings.EMBEDDING_MODEL,
+                settings.CACHE_DIR / "models",
+                settings.EMBEDDING_MAX_SEQ_LENGTH
+            )
+            self.precision = "int8"
+            print(f"✓ Loaded embedding model: {settings.EMBEDDING_MODEL} (onnx, int8)")
+            return
+        
         try:
             from sentence_transformers import SentenceTransformer
             
+            device = settings.EMBEDDING_DEVICE
+            if device is None:
+                try:
+                    import torch
+                    device = "cuda" if torch.cuda.is_available() else "cpu"
+                except ImportError:
+                    device = "cpu"
+            
             # Load model - will download once, then cached locally
             self._model = SentenceTransformer(
                 settings.EMBEDDING_MODEL,
-                cache_folder=str(settings.CACHE_DIR / "models")
+                cache_folder=str(settings.CACHE_DIR / "models"),
+                device=device
             )
-            print(f"✓ Loaded embedding model: {settings.EMBEDDING_MODEL}")
+            
+            # Half precision halves weight memory and roughly doubles GPU
+            # throughput; CPUs have no fast fp16 matmul, so stay fp32 there
+            if settings.EMBEDDING_PRECISION == "fp16" and device.startswith("cuda"):
+                self._model.half()
+                self.precision = "fp16"
+            
+            print(f"✓ Loaded embedding model: {settings.EMBEDDING_MODEL} ({device}, {self.precision})")
         except Exception as e:
             print(f"✗ Failed to load embedding model: {e}")
             raise
     
+    def warmup(self):
+        """Run one encode (bypassing the cache) so model/kernel setup isn't paid by the first query"""
+        self._model.encode(["warmup"], convert_to_numpy=True, normalize_embeddings=True)
+    
     def embed_text(self, text: str) -> np.ndarray:
         """Embed a single text string"""
         if not text.strip():
-            return np.zeros(settings.EMBEDDING_DIMENSION)
+            return np.zeros(settings.EMBEDDING_DIMENSION, dtype=np.float32)
+        
+        key = self._cache_key(text)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached.copy()
         
         embedding = self._model.encode(
             text,
             convert_to_numpy=True,
             normalize_embeddings=True
         )
+        self._cache.put_many([key], [embedding])
         return embedding
     
     def embed_batch(self, texts: List[str]) -> np.ndarray:
         """Embed multiple texts efficiently"""
+        # Empty texts stay as zero rows. float32 matches the FAISS index
+        # and keeps similarity math on single-precision BLAS
+        result = np.zeros((len(texts), settings.EMBEDDING_DIMENSION), dtype=np.float32)
         if not texts:
-            return np.array([])
+            return result
         
-        # Filter empty texts but keep track of indices
-        valid_indices = [i for i, t in enumerate(texts) if t.strip()]
-        valid_texts = [texts[i] for i in valid_indices]
+        # Serve previously seen texts from the cache; misses are grouped
+        # by key so duplicates within the batch are encoded once
+        hit_rows, hit_vectors = [], []
+        misses: Dict[bytes, List[int]] = {}
+        for i, text in enumerate(texts):
+            if not text.strip():
+                continue
+            key = self._cache_key(text)
+            cached = self._cache.get(key)
+            if cached is not None:
+                hit_rows.append(i)
+                hit_vectors.append(cached)
+            else:
+                misses.setdefault(key, []).append(i)
         
-        if not valid_texts:
-            return np.zeros((len(texts), settings.EMBEDDING_DIMENSION))
+        if hit_rows:
+            result[hit_rows] = np.stack(hit_vectors)
+        if not misses:
+            return result
         
-        # Batch encode
+        # Batch encode only the misses
+        miss_keys = list(misses)
+        miss_texts = [texts[misses[key][0]] for key in miss_keys]
         embeddings = self._model.encode(
-            valid_texts,
+            miss_texts,
             batch_size=settings.EMBEDDING_BATCH_SIZE,
             convert_to_numpy=True,
             normalize_embeddings=True,
-            show_progress_bar=len(valid_texts) > 100
+            show_progress_bar=len(miss_texts) > 100
         )
+        self._cache.put_many(miss_keys, embeddings)
         
-        # Reconstruct full array with zeros for empty texts
-        result = np.zeros((len(texts), settings.EMBEDDING_DIMENSION))
-        for i, valid_idx in enumerate(valid_indices):
-            result[valid_idx] = embeddings[i]
+        # Scatter to every position of each miss in one fancy assignment
+        rows = [i for key in miss_keys for i in misses[key]]
+        sources = [n for n, key in enumerate(miss_keys) for _ in misses[key]]
+        result[rows] = embeddings[sources]
         
         return result
     
     def compute_similarity(self, query_emb: np.ndarray, doc_embs: np.ndarray) -> np.ndarray:
         """Compute cosine similarity between query and documents"""
-        # Embeddings are already normalized, so dot product = cosine similarity
-        return np.dot(doc_embs, query_emb)
+        # Embeddings are already normalized, so dot product = cosine similarity.
+        # float32 operands dispatch to BLAS sgemv rather than dgemv
+        return np.matmul(
+            doc_embs.astype(np.float32, copy=False),
+            query_emb.astype(np.float32, copy=False)
+        )
+    
+    def _cache_key(self, text: str) -> bytes:
+        """Cache key for a text: 16-byte BLAKE2b digest of the stripped text"""
+        return hashlib.blake2b(text.strip().encode(), digest_size=EmbeddingCache.KEY_SIZE).digest()
     
     def get_embedding_hash(self, text: str) -> str:
         """Get a hash of the embedding for caching"""
-        return hashlib.sha256(text.encode()).hexdigest()[:16]
+        return blake3(text.encode()).hexdigest(length=8)
 
 
 # Singleton instance
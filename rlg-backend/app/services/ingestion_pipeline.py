@@ -0,0 +1,282 @@
+"""
+Ingestion Pipeline - Streams uploaded documents through bounded queues
+Load -> Transform -> Embed -> Upsert, so concurrent uploads overlap
+"""
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional, Set
+
+import numpy as np
+from sqlalchemy import func
+
+from app.core.config import settings
+from app.core.database import get_db
+from app.models.document import Document, DocumentStatus
+from app.models.chunk import Chunk
+from app.services.ingestion_service import IngestionService
+from app.services.embedding_service import embedding_service
+from app.services.vector_index_service import vector_index
+
+
+@dataclass
+class ChunkBatch:
+    """A micro-batch of one document's chunks moving through the pipeline"""
+    document_id: str
+    chunk_ids: List[str]
+    contents: List[str]
+    last: bool  # Final batch for this document
+    embeddings: Optional[np.ndarray] = None
+    error: Optional[Exception] = None
+
+
+class IngestionPipeline:
+    """
+    Four stages connected by bounded queues:
+    - Load: claims a PENDING document (marks it PROCESSING)
+    - Transform: parses and chunks it, emitting micro-batches
+    - Embed: encodes each batch
+    - Upsert: adds vectors to FAISS; persists once per run of documents
+      finishing back to back, then marks them INDEXED
+    
+    While one document embeds the next one is being parsed. Bounded
+    queues apply backpressure, so a burst of uploads waits in submit()
+    instead of piling up in memory. Embed and Upsert run a single worker
+    each: the model and the FAISS index are shared, and FIFO order keeps
+    each document's batches in sequence.
+    """
+    
+    def __init__(self):
+        self.load_q: Optional[asyncio.Queue] = None
+        self.transform_q: Optional[asyncio.Queue] = None
+        self.embed_q: Optional[asyncio.Queue] = None
+        self.upsert_q: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._failed: Set[str] = set()
+        self._finished: List[str] = []  # Fully upserted, not yet persisted
+    
+    async def start(self):
+        """Create the queues and start the stage workers (call from lifespan)"""
+        size = settings.INGEST_QUEUE_SIZE
+        self.load_q = asyncio.Queue(maxsize=size)
+        self.transform_q = asyncio.Queue(maxsize=size)
+        self.embed_q = asyncio.Queue(maxsize=size)
+        self.upsert_q = asyncio.Queue(maxsize=size)
+        
+        self._workers = [
+            asyncio.create_task(self._load_worker()),
+            *(
+                asyncio.create_task(self._transform_worker())
+                for _ in range(settings.INGEST_TRANSFORM_WORKERS)
+            ),
+            asyncio.create_task(self._embed_worker()),
+            asyncio.create_task(self._upsert_worker()),
+            # Pick up uploads that were accepted before the last shutdown
+            asyncio.create_task(self._requeue_pending()),
+        ]
+    
+    async def stop(self):
+        """Cancel the workers; unfinished documents are requeued on next start"""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+    
+    async def submit(self, document_id: str):
+        """Queue a registered document (waits while the pipeline is full)"""
+        await self.load_q.put(document_id)
+    
+    # Stage workers
+    
+    async def _load_worker(self):
+        """Load stage: claim the document, then hand it to Transform"""
+        while True:
+            document_id = await self.load_q.get()
+            try:
+                if await asyncio.to_thread(self._claim, document_id):
+                    await self.transform_q.put(document_id)
+            except Exception as e:
+                await asyncio.to_thread(self._mark_failed, document_id, e)
+            finally:
+                self.load_q.task_done()
+    
+    async def _transform_worker(self):
+        """Transform stage: parse and chunk, emit micro-batches to Embed"""
+        while True:
+            document_id = await self.transform_q.get()
+            try:
+                chunk_ids, contents = await asyncio.to_thread(self._chunk, document_id)
+                
+                # Micro-batches sized for the embedding model; a document
+                # with no chunks still sends one (empty) final batch
+                batch_size = settings.EMBEDDING_BATCH_SIZE
+                starts = range(0, len(chunk_ids), batch_size) or [0]
+                for start in starts:
+                    await self.embed_q.put(ChunkBatch(
+                        document_id=document_id,
+                        chunk_ids=chunk_ids[start:start + batch_size],
+                        contents=contents[start:start + batch_size],
+                        last=start + batch_size >= len(chunk_ids)
+                    ))
+            except Exception as e:
+                await asyncio.to_thread(self._mark_failed, document_id, e)
+            finally:
+                self.transform_q.task_done()
+    
+    async def _embed_worker(self):
+        """Embed stage: encode each batch off the event loop"""
+        while True:
+            batch = await self.embed_q.get()
+            try:
+                if batch.document_id not in self._failed and batch.contents:
+                    batch.embeddings = await asyncio.to_thread(
+                        embedding_service.embed_batch, batch.contents
+                    )
+            except Exception as e:
+                # Upsert owns the index, so it handles the cleanup
+                batch.error = e
+            try:
+                await self.upsert_q.put(batch)
+            finally:
+                self.embed_q.task_done()
+    
+    async def _upsert_worker(self):
+        """
+        Upsert stage: add vectors. A document is finished after its last
+        batch, but the index is only written once the queue runs dry, so
+        a burst of documents shares one write.
+        """
+        while True:
+            batch = await self.upsert_q.get()
+            try:
+                if batch.document_id in self._failed:
+                    # Leftover batch of a failed document; no `continue`, so
+                    # the flush check below still runs if it ends a burst
+                    if batch.last:
+                        self._failed.discard(batch.document_id)
+                else:
+                    if batch.error:
+                        raise batch.error
+                    
+                    if batch.embeddings is not None:
+                        # In a thread: the add may first reload a memory-mapped
+                        # index, and it waits on the index lock
+                        await asyncio.to_thread(
+                            vector_index.add_embeddings, batch.chunk_ids, batch.embeddings, False
+                        )
+                    if batch.last:
+                        self._finished.append(batch.document_id)
+            except Exception as e:
+                # Skip the rest of this document's batches
+                if not batch.last:
+                    self._failed.add(batch.document_id)
+                await asyncio.to_thread(self._mark_failed, batch.document_id, e, True)
+            finally:
+                self.upsert_q.task_done()
+            
+            if self._finished and self.upsert_q.empty():
+                finished, self._finished = self._finished, []
+                try:
+                    await asyncio.to_thread(self._finish, finished)
+                except Exception as e:
+                    for document_id in finished:
+                        await asyncio.to_thread(self._mark_failed, document_id, e, True)
+    
+    async def _requeue_pending(self):
+        """
+        Resubmit documents left unfinished by a previous run: PENDING ones,
+        and PROCESSING ones interrupted mid-pipeline (reset first)
+        """
+        def pending_ids():
+            self._reset_interrupted()
+            with get_db() as db:
+                rows = db.query(Document.id).filter(
+                    Document.status == DocumentStatus.PENDING
+                ).order_by(Document.created_at).all()
+                return [r.id for r in rows]
+        
+        for document_id in await asyncio.to_thread(pending_ids):
+            await self.submit(document_id)
+    
+    # Blocking helpers, run in worker threads
+    
+    def _reset_interrupted(self):
+        """
+        Move PROCESSING documents back to PENDING, dropping their partial
+        chunks and any vectors a later flush may have persisted
+        """
+        with get_db() as db:
+            document_ids = [
+                r.id for r in db.query(Document.id).filter(
+                    Document.status == DocumentStatus.PROCESSING
+                )
+            ]
+            if not document_ids:
+                return
+            
+            chunk_ids = [
+                r.id for r in db.query(Chunk.id).filter(Chunk.document_id.in_(document_ids))
+            ]
+            vector_index.remove_chunks(chunk_ids)
+            db.query(Chunk).filter(
+                Chunk.document_id.in_(document_ids)
+            ).delete(synchronize_session=False)
+            db.query(Document).filter(Document.id.in_(document_ids)).update({
+                Document.status: DocumentStatus.PENDING,
+                Document.chunk_count: 0
+            }, synchronize_session=False)
+            db.commit()
+    
+    def _claim(self, document_id: str) -> bool:
+        """Move a PENDING document to PROCESSING; False if it is gone or taken"""
+        with get_db() as db:
+            document = db.query(Document).filter(Document.id == document_id).first()
+            if not document or document.status != DocumentStatus.PENDING:
+                return False
+            if not Path(document.filepath).exists():
+                raise FileNotFoundError(f"Source file missing: {document.filepath}")
+            
+            document.status = DocumentStatus.PROCESSING
+            db.commit()
+            return True
+    
+    def _chunk(self, document_id: str):
+        """Parse and store a document's chunks; returns (chunk_ids, contents)"""
+        with get_db() as db:
+            document = db.query(Document).filter(Document.id == document_id).first()
+            IngestionService(db).process_file(document, mark_indexed=False)
+            # Length order keeps each embedding micro-batch evenly padded
+            rows = db.query(Chunk.id, Chunk.content).filter(
+                Chunk.document_id == document_id
+            ).order_by(func.length(Chunk.content)).all()
+            return [r.id for r in rows], [r.content for r in rows]
+    
+    def _finish(self, document_ids: List[str]):
+        """Write the index to disk and mark the documents INDEXED"""
+        vector_index.flush()
+        with get_db() as db:
+            db.query(Document).filter(Document.id.in_(document_ids)).update({
+                Document.status: DocumentStatus.INDEXED,
+                Document.indexed_at: datetime.utcnow()
+            }, synchronize_session=False)
+            db.commit()
+    
+    def _mark_failed(self, document_id: str, error: Exception, drop_vectors: bool = False):
+        """Mark a document FAILED, removing vectors already added if asked"""
+        with get_db() as db:
+            if drop_vectors:
+                chunk_ids = [
+                    r.id for r in db.query(Chunk.id).filter(Chunk.document_id == document_id)
+                ]
+                vector_index.remove_chunks(chunk_ids)
+            
+            db.query(Document).filter(Document.id == document_id).update({
+                Document.status: DocumentStatus.FAILED,
+                Document.error_message: f"Indexing failed: {error}"
+            }, synchronize_session=False)
+            db.commit()
+
+
+# Singleton instance
+ingestion_pipeline = IngestionPipeline()
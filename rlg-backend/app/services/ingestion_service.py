@@ -2,18 +2,98 @@
 Ingestion Service - Document processing and chunking
 Handles PDF, DOCX, TXT, HTML with structure preservation
 """
-import hashlib
+from blake3 import blake3
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Optional, Tuple, Generator
+from typing import Any, Dict, List, Optional, Tuple, Generator
 from datetime import datetime
+import hashlib
 import json
+import multiprocessing
+import os
 import re
+import threading
+import uuid
 
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 
 from app.core.config import settings
+from app.core.database import blake3_hashes_migrated
 from app.models.document import Document, DocumentStatus, DocumentType
 from app.models.chunk import Chunk, ChunkType
+from app.utils.bloom import HashBloomFilter
+from app.utils.pdf import extract_page_texts
+
+
+# Rows per bulk INSERT statement
+CHUNK_INSERT_BATCH = 10000
+
+# Column values for one chunks row. Ingestion builds these instead of
+# Chunk objects, skipping ORM attribute instrumentation per field
+ChunkRow = Dict[str, Any]
+
+# Read size when a file has to be hashed without mmap
+HASH_READ_BUFFER = 1024 * 1024
+
+# Document type by file extension (anything else is read as text)
+_FILE_TYPES = {
+    ".pdf": DocumentType.PDF,
+    ".docx": DocumentType.DOCX,
+    ".doc": DocumentType.DOCX,
+    ".txt": DocumentType.TXT,
+    ".html": DocumentType.HTML,
+    ".htm": DocumentType.HTML,
+    ".xlsx": DocumentType.XLSX,
+    ".xls": DocumentType.XLSX,
+    ".md": DocumentType.MARKDOWN,
+    ".png": DocumentType.IMAGE,
+    ".jpg": DocumentType.IMAGE,
+    ".jpeg": DocumentType.IMAGE,
+}
+
+# Patterns compiled once at import
+_DIGIT_RE = re.compile(r"\d")
+_MD_HEADER_RE = re.compile(r"^(#{1,6})\s+(.+)$")
+_PARA_SPLIT_RE = re.compile(r"\n\s*\n")
+# Sentence end: punctuation then whitespace. Matched directly rather than
+# split on a (?<=[.!?]) lookbehind, so the engine can skip ahead to
+# candidate punctuation instead of testing the lookbehind at every offset
+_SENT_END_RE = re.compile(r"[.!?]\s+")
+
+# Bloom filter of known document hashes, built on first upload
+_file_hash_filter: Optional[HashBloomFilter] = None
+_file_hash_filter_lock = threading.Lock()
+
+# Worker processes for PDF text extraction, shared across documents
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+_pdf_pool_lock = threading.Lock()
+
+
+def compute_file_hash(filepath: Path) -> str:
+    """
+    BLAKE3 hash of file content (deduplication, not integrity).
+    Hashes straight from a memory map, SIMD and multithreaded.
+    """
+    hasher = blake3(max_threads=blake3.AUTO)
+    try:
+        hasher.update_mmap(filepath)
+    except OSError:
+        # Some filesystems can't be mapped; stream it instead
+        hasher = blake3(max_threads=blake3.AUTO)
+        with open(filepath, "rb") as f:
+            for block in iter(lambda: f.read(HASH_READ_BUFFER), b""):
+                hasher.update(block)
+    return hasher.hexdigest()
+
+
+def compute_legacy_file_hash(filepath: Path) -> str:
+    """SHA-256 of file content, as stored by versions before BLAKE3"""
+    sha256 = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(HASH_READ_BUFFER), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
 
 
 class IngestionService:
@@ -25,14 +105,27 @@ class IngestionService:
     def __init__(self, db: Session):
         self.db = db
     
-    def ingest_file(
+    def ingest_file(self, filepath: Path, metadata: Optional[dict] = None) -> Document:
+        """
+        Main entry point for synchronous document ingestion.
+        Returns the created Document with its chunks.
+        """
+        document, created = self.register_file(filepath, metadata)
+        if not created:
+            return document
+        return self.process_file(document)
+    
+    def register_file(
         self,
         filepath: Path,
-        metadata: Optional[dict] = None
-    ) -> Document:
+        metadata: Optional[dict] = None,
+        file_hash: Optional[str] = None
+    ) -> Tuple[Document, bool]:
         """
-        Main entry point for document ingestion.
-        Returns the created Document with its chunks.
+        Create a PENDING Document record for a saved file.
+        Returns (document, created); an existing document with the same
+        content hash is returned as-is with created=False. Pass file_hash
+        if the BLAKE3 hash was already computed while saving the file.
         """
         metadata = metadata or {}
         
@@ -40,14 +133,21 @@ class IngestionService:
         file_type = self._detect_file_type(filepath)
         
         # Compute file hash for deduplication
-        file_hash = self._compute_file_hash(filepath)
+        file_hash = file_hash or compute_file_hash(filepath)
+        candidates = [file_hash]
+        if not blake3_hashes_migrated(self.db):
+            # Rows from before BLAKE3 hold SHA-256 until init_db rehashes them
+            candidates.append(compute_legacy_file_hash(filepath))
         
-        # Check for duplicate
-        existing = self.db.query(Document).filter(
-            Document.file_hash == file_hash
-        ).first()
-        if existing:
-            return existing
+        # Check for duplicate. The filter rules out most new files without
+        # a query; a hit (maybe a false positive) is confirmed in the DB
+        candidates = [h for h in candidates if self._file_hash_known(h)]
+        if candidates:
+            existing = self.db.query(Document).filter(
+                Document.file_hash.in_(candidates)
+            ).first()
+            if existing:
+                return existing, False
         
         # Create document record
         document = Document(
@@ -56,28 +156,39 @@ class IngestionService:
             file_type=file_type,
             file_size=filepath.stat().st_size,
             file_hash=file_hash,
-            status=DocumentStatus.PROCESSING,
+            status=DocumentStatus.PENDING,
             **metadata
         )
         self.db.add(document)
-        self.db.flush()
+        self.db.commit()
+        self._file_hash_known(file_hash, add=True)
+        return document, True
+    
+    def process_file(self, document: Document, mark_indexed: bool = True) -> Document:
+        """
+        Parse and chunk a registered document and store its chunks.
+        With mark_indexed=False the document is left in PROCESSING so the
+        caller can finish vector indexing later.
+        """
+        document.status = DocumentStatus.PROCESSING
         
         try:
             # Extract and chunk content
-            chunks = self._process_document(document, filepath)
+            chunks = self._process_document(document, Path(document.filepath))
             
             # Store chunks
-            for chunk in chunks:
-                self.db.add(chunk)
+            self.store_chunks(chunks)
             
             # Update document status
-            document.status = DocumentStatus.INDEXED
             document.chunk_count = len(chunks)
-            document.indexed_at = datetime.utcnow()
+            if mark_indexed:
+                document.status = DocumentStatus.INDEXED
+                document.indexed_at = datetime.utcnow()
             
             self.db.commit()
             
         except Exception as e:
+            self.db.rollback()
             document.status = DocumentStatus.FAILED
             document.error_message = str(e)
             self.db.commit()
@@ -85,34 +196,51 @@ class IngestionService:
         
         return document
     
+    def store_chunks(self, chunks: List[ChunkRow]):
+        """
+        Insert chunk rows with bulk INSERTs (executemany) instead of a
+        unit-of-work flush per object. Ingestion builds chunks as plain
+        column dicts, so no instrumented ORM attributes are involved;
+        ids and content hashes are filled in here, so callers can still
+        read chunk["id"].
+        """
+        for chunk in chunks:
+            if chunk.get("id") is None:
+                chunk["id"] = str(uuid.uuid4())
+            # Hash the final content (small chunks may have been merged)
+            chunk["content_hash"] = blake3(chunk["content"].encode()).hexdigest(length=16)
+        
+        for start in range(0, len(chunks), CHUNK_INSERT_BATCH):
+            self.db.execute(insert(Chunk), chunks[start:start + CHUNK_INSERT_BATCH])
+    
     def _detect_file_type(self, filepath: Path) -> DocumentType:
         """Detect document type from extension"""
-        ext = filepath.suffix.lower()
-        mapping = {
-            ".pdf": DocumentType.PDF,
-            ".docx": DocumentType.DOCX,
-            ".doc": DocumentType.DOCX,
-            ".txt": DocumentType.TXT,
-            ".html": DocumentType.HTML,
-            ".htm": DocumentType.HTML,
-            ".xlsx": DocumentType.XLSX,
-            ".xls": DocumentType.XLSX,
-            ".md": DocumentType.MARKDOWN,
-            ".png": DocumentType.IMAGE,
-            ".jpg": DocumentType.IMAGE,
-            ".jpeg": DocumentType.IMAGE,
-        }
-        return mapping.get(ext, DocumentType.TXT)
+        return _FILE_TYPES.get(filepath.suffix.lower(), DocumentType.TXT)
     
-    def _compute_file_hash(self, filepath: Path) -> str:
-        """Compute SHA-256 hash of file content"""
-        sha256 = hashlib.sha256()
-        with open(filepath, "rb") as f:
-            for chunk in iter(lambda: f.read(8192), b""):
-                sha256.update(chunk)
-        return sha256.hexdigest()
+    def _file_hash_known(self, file_hash: str, add: bool = False) -> bool:
+        """
+        Membership test (or insert) on the process-wide file hash filter,
+        loading it from the documents table on first use.
+        """
+        global _file_hash_filter
+        with _file_hash_filter_lock:
+            if _file_hash_filter is None:
+                hashes = [
+                    h for (h,) in self.db.query(Document.file_hash).filter(
+                        Document.file_hash.isnot(None)
+                    )
+                ]
+                _file_hash_filter = HashBloomFilter(
+                    max(settings.FILE_HASH_FILTER_CAPACITY, 2 * len(hashes))
+                )
+                _file_hash_filter.update(hashes)
+            
+            if add:
+                _file_hash_filter.add(file_hash)
+                return True
+            return file_hash in _file_hash_filter
     
-    def _process_document(self, document: Document, filepath: Path) -> List[Chunk]:
+    def _process_document(self, document: Document, filepath: Path) -> List[ChunkRow]:
         """Route to appropriate processor based on file type"""
         processors = {
             DocumentType.PDF: self._process_pdf,
@@ -125,16 +253,11 @@ class IngestionService:
         processor = processors.get(document.file_type, self._process_text)
         return processor(document, filepath)
     
-    def _process_pdf(self, document: Document, filepath: Path) -> List[Chunk]:
+    def _process_pdf(self, document: Document, filepath: Path) -> List[ChunkRow]:
         """Process PDF with page tracking"""
-        from pypdf import PdfReader
-        
         chunks = []
-        reader = PdfReader(str(filepath))
-        document.page_count = len(reader.pages)
         
-        for page_num, page in enumerate(reader.pages, 1):
-            text = page.extract_text() or ""
+        for page_num, text in self._pdf_page_texts(document, filepath):
             if not text.strip():
                 continue
             
@@ -148,7 +271,60 @@ class IngestionService:
         
         return chunks
     
-    def _process_docx(self, document: Document, filepath: Path) -> List[Chunk]:
+    def _pdf_page_texts(self, document: Document, filepath: Path):
+        """
+        Yield (page_number, text) for each page and set document.page_count.
+        Uses PyMuPDF (C-backed, much faster) when installed, else pypdf.
+        With PyMuPDF, large PDFs are split into page ranges extracted in
+        parallel worker processes.
+        """
+        try:
+            import pymupdf
+        except ImportError:
+            from pypdf import PdfReader
+            
+            reader = PdfReader(str(filepath))
+            document.page_count = len(reader.pages)
+            for page_num, page in enumerate(reader.pages, 1):
+                yield page_num, page.extract_text() or ""
+            return
+        
+        with pymupdf.open(str(filepath)) as doc:
+            page_count = document.page_count = doc.page_count
+            if page_count < settings.PDF_PARALLEL_MIN_PAGES:
+                texts = [page.get_text("text") for page in doc]
+            else:
+                texts = None
+        
+        if texts is None:
+            texts = self._extract_pdf_parallel(filepath, page_count)
+        yield from enumerate(texts, 1)
+    
+    def _extract_pdf_parallel(self, filepath: Path, page_count: int) -> List[str]:
+        """Page texts in order, extracted by the shared process pool"""
+        global _pdf_pool
+        workers = settings.PDF_EXTRACT_WORKERS or os.cpu_count() or 1
+        with _pdf_pool_lock:
+            if _pdf_pool is None:
+                # spawn, not fork: the parent has model and FAISS threads
+                _pdf_pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+        
+        # A couple of ranges per worker evens out pages of uneven cost
+        step = max(1, -(-page_count // (workers * 2)))
+        futures = [
+            _pdf_pool.submit(extract_page_texts, str(filepath), start, min(start + step, page_count))
+            for start in range(0, page_count, step)
+        ]
+        
+        texts = []
+        for future in futures:
+            texts.extend(future.result())
+        return texts
+    
+    def _process_docx(self, document: Document, filepath: Path) -> List[ChunkRow]:
         """Process DOCX with heading structure"""
         from docx import Document as DocxDoc
         
@@ -165,8 +341,9 @@ class IngestionService:
             style = para.style.name.lower() if para.style else ""
             if "heading" in style:
                 current_section = text
-                heading_level = int(re.search(r"\d", style).group()) if re.search(r"\d", style) else 1
-                chunk = Chunk(
+                level_match = _DIGIT_RE.search(style)
+                heading_level = int(level_match.group()) if level_match else 1
+                chunk = dict(
                     document_id=document.id,
                     content=text,
                     chunk_type=ChunkType.HEADING.value,
@@ -175,7 +352,7 @@ class IngestionService:
                     confidence_weight=1.2  # Boost headings
                 )
             else:
-                chunk = Chunk(
+                chunk = dict(
                     document_id=document.id,
                     content=text,
                     chunk_type=ChunkType.PARAGRAPH.value,
@@ -187,24 +364,33 @@ class IngestionService:
         
         return self._merge_small_chunks(chunks)
     
-    def _process_text(self, document: Document, filepath: Path) -> List[Chunk]:
+    def _process_text(self, document: Document, filepath: Path) -> List[ChunkRow]:
         """Process plain text file"""
         with open(filepath, "r", encoding="utf-8", errors="ignore") as f:
             text = f.read()
         
         return self._chunk_text_with_structure(text, document)
     
-    def _process_html(self, document: Document, filepath: Path) -> List[Chunk]:
+    def _process_html(self, document: Document, filepath: Path) -> List[ChunkRow]:
         """Process HTML with semantic structure"""
-        from bs4 import BeautifulSoup
+        from bs4 import BeautifulSoup, SoupStrainer
+        
+        # Only build the tags we extract; lxml (libxml2) parses several
+        # times faster than the pure-Python html.parser
+        content_tags = ["h1", "h2", "h3", "h4", "h5", "h6", "p", "li"]
+        try:
+            import lxml  # noqa: F401
+            parser = "lxml"
+        except ImportError:
+            parser = "html.parser"
         
         with open(filepath, "r", encoding="utf-8", errors="ignore") as f:
-            soup = BeautifulSoup(f.read(), "html.parser")
+            soup = BeautifulSoup(f, parser, parse_only=SoupStrainer(content_tags))
         
         chunks = []
         
         # Extract headings and paragraphs
-        for tag in soup.find_all(["h1", "h2", "h3", "h4", "h5", "h6", "p", "li"]):
+        for tag in soup.find_all(content_tags):
             text = tag.get_text(strip=True)
             if not text:
                 continue
@@ -222,7 +408,7 @@ class IngestionService:
                 level = None
                 weight = 1.0
             
-            chunk = Chunk(
+            chunk = dict(
                 document_id=document.id,
                 content=text,
                 chunk_type=chunk_type,
@@ -233,7 +419,7 @@ class IngestionService:
         
         return self._merge_small_chunks(chunks)
     
-    def _process_markdown(self, document: Document, filepath: Path) -> List[Chunk]:
+    def _process_markdown(self, document: Document, filepath: Path) -> List[ChunkRow]:
         """Process Markdown with header structure"""
         with open(filepath, "r", encoding="utf-8", errors="ignore") as f:
             content = f.read()
@@ -241,18 +427,18 @@ class IngestionService:
         chunks = []
         current_section = None
         
-        for line in content.split("\n"):
+        for line in content.splitlines():
             line = line.strip()
             if not line:
                 continue
             
-            # Detect headers
-            header_match = re.match(r"^(#{1,6})\s+(.+)$", line)
+            # Detect headers (only lines starting with "#" can be one)
+            header_match = _MD_HEADER_RE.match(line) if line[0] == "#" else None
             if header_match:
                 level = len(header_match.group(1))
                 text = header_match.group(2)
                 current_section = text
-                chunk = Chunk(
+                chunk = dict(
                     document_id=document.id,
                     content=text,
                     chunk_type=ChunkType.HEADING.value,
@@ -261,7 +447,7 @@ class IngestionService:
                     confidence_weight=1.2
                 )
             else:
-                chunk = Chunk(
+                chunk = dict(
                     document_id=document.id,
                     content=line,
                     chunk_type=ChunkType.PARAGRAPH.value,
@@ -273,7 +459,7 @@ class IngestionService:
         
         return self._merge_small_chunks(chunks)
     
-    def _process_image(self, document: Document, filepath: Path) -> List[Chunk]:
+    def _process_image(self, document: Document, filepath: Path) -> List[ChunkRow]:
         """Process image with OCR"""
         try:
             import pytesseract
@@ -297,135 +483,107 @@ class IngestionService:
         text: str,
         document: Document,
         page_number: Optional[int] = None
-    ) -> List[Chunk]:
+    ) -> List[ChunkRow]:
         """
         Smart chunking that preserves sentence boundaries and semantic units.
         Better than naive fixed-size chunking.
         """
         chunks = []
-        
-        # Split into paragraphs first
-        paragraphs = re.split(r"\n\s*\n", text)
+        chunk_size = settings.CHUNK_SIZE
         
         current_chunk = []
         current_length = 0
-        sequence_index = 0
         
-        for para in paragraphs:
-            para = para.strip()
-            if not para:
-                continue
-            
-            para_length = len(para)
+        # One packing loop over paragraphs and sentences alike
+        for unit in self._chunk_units(text, chunk_size):
+            if current_length + len(unit) > chunk_size and current_chunk:
+                chunks.append(self._emit_chunk(document, current_chunk, len(chunks), page_number))
+                current_chunk.clear()
+                current_length = 0
             
-            # If paragraph itself exceeds chunk size, split by sentences
-            if para_length > settings.CHUNK_SIZE:
-                # Flush current chunk
-                if current_chunk:
-                    content = " ".join(current_chunk)
-                    chunk = Chunk(
-                        document_id=document.id,
-                        content=content,
-                        page_number=page_number,
-                        chunk_type=ChunkType.PARAGRAPH.value,
-                        sequence_index=sequence_index,
-                        confidence_weight=1.0,
-                        content_hash=hashlib.sha256(content.encode()).hexdigest()[:32]
-                    )
-                    chunks.append(chunk)
-                    sequence_index += 1
-                    current_chunk = []
-                    current_length = 0
-                
-                # Split large paragraph by sentences
-                sentences = re.split(r"(?<=[.!?])\s+", para)
-                for sent in sentences:
-                    sent = sent.strip()
-                    if not sent:
-                        continue
-                    
-                    if current_length + len(sent) > settings.CHUNK_SIZE and current_chunk:
-                        content = " ".join(current_chunk)
-                        chunk = Chunk(
-                            document_id=document.id,
-                            content=content,
-                            page_number=page_number,
-                            chunk_type=ChunkType.PARAGRAPH.value,
-                            sequence_index=sequence_index,
-                            confidence_weight=1.0,
-                            content_hash=hashlib.sha256(content.encode()).hexdigest()[:32]
-                        )
-                        chunks.append(chunk)
-                        sequence_index += 1
-                        current_chunk = []
-                        current_length = 0
-                    
-                    current_chunk.append(sent)
-                    current_length += len(sent) + 1
-            else:
-                # Add whole paragraph
-                if current_length + para_length > settings.CHUNK_SIZE and current_chunk:
-                    content = " ".join(current_chunk)
-                    chunk = Chunk(
-                        document_id=document.id,
-                        content=content,
-                        page_number=page_number,
-                        chunk_type=ChunkType.PARAGRAPH.value,
-                        sequence_index=sequence_index,
-                        confidence_weight=1.0,
-                        content_hash=hashlib.sha256(content.encode()).hexdigest()[:32]
-                    )
-                    chunks.append(chunk)
-                    sequence_index += 1
-                    current_chunk = []
-                    current_length = 0
-                
-                current_chunk.append(para)
-                current_length += para_length + 1
+            current_chunk.append(unit)
+            current_length += len(unit) + 1
         
         # Flush remaining
         if current_chunk:
-            content = " ".join(current_chunk)
-            chunk = Chunk(
-                document_id=document.id,
-                content=content,
-                page_number=page_number,
-                chunk_type=ChunkType.PARAGRAPH.value,
-                sequence_index=sequence_index,
-                confidence_weight=1.0,
-                content_hash=hashlib.sha256(content.encode()).hexdigest()[:32]
-            )
-            chunks.append(chunk)
+            chunks.append(self._emit_chunk(document, current_chunk, len(chunks), page_number))
         
         return chunks
     
-    def _merge_small_chunks(self, chunks: List[Chunk], min_size: int = 100) -> List[Chunk]:
+    @staticmethod
+    def _chunk_units(text: str, chunk_size: int) -> Generator[str, None, None]:
+        """Paragraphs, with any paragraph longer than chunk_size split into sentences"""
+        for para in _PARA_SPLIT_RE.split(text):
+            para = para.strip()
+            if not para:
+                continue
+            
+            if len(para) <= chunk_size:
+                yield para
+                continue
+            
+            start = 0
+            for match in _SENT_END_RE.finditer(para):
+                yield para[start:match.start() + 1]
+                start = match.end()
+            if start < len(para):
+                yield para[start:]
+    
+    def _emit_chunk(
+        self,
+        document: Document,
+        parts: List[str],
+        sequence_index: int,
+        page_number: Optional[int]
+    ) -> ChunkRow:
+        """Paragraph chunk row from the buffered parts (hashed later, in store_chunks)"""
+        return dict(
+            document_id=document.id,
+            content=" ".join(parts),
+            page_number=page_number,
+            chunk_type=ChunkType.PARAGRAPH.value,
+            sequence_index=sequence_index,
+            confidence_weight=1.0
+        )
+    
+    def _merge_small_chunks(self, chunks: List[ChunkRow], min_size: int = 100) -> List[ChunkRow]:
         """Merge very small chunks with adjacent ones"""
         if len(chunks) < 2:
             return chunks
         
         merged = []
-        buffer = None
+        # Run of consecutive small, non-heading chunks; its contents are
+        # joined once when the run ends instead of growing by +=
+        run: List[ChunkRow] = []
+        run_length = 0  # Length of the run's contents joined by spaces
         
         for chunk in chunks:
-            if len(chunk.content) < min_size and chunk.chunk_type != ChunkType.HEADING.value:
-                if buffer:
-                    buffer.content += " " + chunk.content
+            if len(chunk["content"]) < min_size and chunk["chunk_type"] != ChunkType.HEADING.value:
+                run_length += len(chunk["content"]) + (1 if run else 0)
+                run.append(chunk)
+                continue
+            
+            if run:
+                if run_length < min_size:
+                    chunk["content"] = " ".join([c["content"] for c in run] + [chunk["content"]])
                 else:
-                    buffer = chunk
-            else:
-                if buffer:
-                    if len(buffer.content) < min_size:
-                        chunk.content = buffer.content + " " + chunk.content
-                    else:
-                        merged.append(buffer)
-                    buffer = None
-                merged.append(chunk)
-        
-        if buffer:
+                    merged.append(self._join_run(run))
+                run = []
+                run_length = 0
+            merged.append(chunk)
+        
+        if run:
             if merged:
-                merged[-1].content += " " + buffer.content
+                merged[-1]["content"] = " ".join([merged[-1]["content"]] + [c["content"] for c in run])
             else:
-                merged.append(buffer)
+                merged.append(self._join_run(run))
         
         return merged
+    
+    @staticmethod
+    def _join_run(run: List[ChunkRow]) -> ChunkRow:
+        """First row of a run, carrying the whole run's content"""
+        first = run[0]
+        if len(run) > 1:
+            first["content"] = " ".join(c["content"] for c in run)
+        return first
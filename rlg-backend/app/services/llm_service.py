@@ -2,14 +2,39 @@
 LLM Service - Local LLM via Ollama
 100% offline after initial model download
 """
-from typing import Optional, AsyncGenerator, Dict, Any
+from typing import Optional, AsyncGenerator, Dict, Any, List, Tuple
+import re
+import time
 import httpx
-import json
+import orjson
 from dataclasses import dataclass
 
 from app.core.config import settings
 
 
+# "quoted text" [n] pairs in extractive answers
+_QUOTE_RE = re.compile(r'"([^"]+)"\s*\[(\d+)\]')
+
+# How long an /api/tags result (or failure) answers availability probes
+TAGS_CACHE_TTL = 2.0
+
+# Extractive QA prompt; only the context and question vary per request
+EXTRACTIVE_PROMPT = """You are an EXTRACTIVE question answering system. You MUST follow these rules:
+
+CRITICAL RULES:
+1. Your answer MUST use EXACT QUOTES from the sources
+2. Place quotes inside "quotation marks"
+3. Add citation markers [1], [2] after each quote
+4. If you cannot find the answer in the sources, respond: "NOT_FOUND"
+5. Do NOT paraphrase - use the exact words from sources
+
+{context}
+
+QUESTION: {question}
+
+EXTRACTIVE ANSWER (quotes with citations only):"""
+
+
 @dataclass
 class LLMResponse:
     """Response from the LLM"""
@@ -38,20 +63,74 @@ class LLMService:
         self.model = model or settings.OLLAMA_MODEL
         self.host = host or settings.OLLAMA_HOST
         self.timeout = timeout
-        self.client = httpx.Client(timeout=timeout)
+        self._client: Optional[httpx.Client] = None
+        self._async_client: Optional[httpx.AsyncClient] = None
+        
+        # Circuit breaker state for the async path
+        self._failures = 0
+        self._open_until = 0.0
+        
+        # (fetched_at, model names or None if unreachable)
+        self._tags_cache: Tuple[float, Optional[List[str]]] = (float("-inf"), None)
     
-    def generate(
+    @property
+    def client(self) -> httpx.Client:
+        """Sync client, created on first use (the API only uses the async path)"""
+        if self._client is None:
+            self._client = httpx.Client(timeout=self.timeout)
+        return self._client
+    
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        """Shared async client, so concurrent requests reuse keep-alive connections"""
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(
+                base_url=self.host,
+                timeout=httpx.Timeout(self.timeout, connect=settings.OLLAMA_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=settings.OLLAMA_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.OLLAMA_MAX_CONNECTIONS
+                )
+            )
+        return self._async_client
+    
+    # Circuit breaker: after OLLAMA_BREAKER_THRESHOLD consecutive connection
+    # failures, async calls fail fast for OLLAMA_BREAKER_COOLDOWN seconds
+    # instead of each waiting out a connect timeout
+    
+    @property
+    def circuit_open(self) -> bool:
+        return time.monotonic() < self._open_until
+    
+    def _record_success(self):
+        self._failures = 0
+        self._open_until = 0.0
+    
+    def _record_failure(self):
+        self._failures += 1
+        if self._failures >= settings.OLLAMA_BREAKER_THRESHOLD:
+            self._open_until = time.monotonic() + settings.OLLAMA_BREAKER_COOLDOWN
+    
+    def _unavailable(self) -> ConnectionError:
+        return ConnectionError(
+            f"Cannot connect to Ollama at {self.host}. "
+            "Make sure Ollama is running: `ollama serve`"
+        )
+    
+    async def aclose(self):
+        """Close the shared async client (call on shutdown)"""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+    
+    def _generate_payload(
         self,
         prompt: str,
-        temperature: float = 0.1,  # Low temp for grounded responses
-        max_tokens: int = 1024,
+        temperature: float,
+        max_tokens: int,
         stop_sequences: Optional[list] = None
-    ) -> LLMResponse:
-        """
-        Generate a response from the local LLM.
-        Uses low temperature for factual, grounded responses.
-        """
-        payload = {
+    ) -> dict:
+        return {
             "model": self.model,
             "prompt": prompt,
             "stream": False,
@@ -61,6 +140,27 @@ class LLMService:
                 "stop": stop_sequences or []
             }
         }
+    
+    def _to_response(self, data: dict) -> LLMResponse:
+        return LLMResponse(
+            text=data.get("response", ""),
+            tokens_used=data.get("eval_count", 0),
+            model=self.model,
+            finish_reason=data.get("done_reason", "unknown")
+        )
+    
+    def generate(
+        self,
+        prompt: str,
+        temperature: float = 0.1,  # Low temp for grounded responses
+        max_tokens: int = 1024,
+        stop_sequences: Optional[list] = None
+    ) -> LLMResponse:
+        """
+        Generate a response from the local LLM.
+        Uses low temperature for factual, grounded responses.
+        """
+        payload = self._generate_payload(prompt, temperature, max_tokens, stop_sequences)
         
         try:
             response = self.client.post(
@@ -68,14 +168,7 @@ class LLMService:
                 json=payload
             )
             response.raise_for_status()
-            data = response.json()
-            
-            return LLMResponse(
-                text=data.get("response", ""),
-                tokens_used=data.get("eval_count", 0),
-                model=self.model,
-                finish_reason=data.get("done_reason", "unknown")
-            )
+            return self._to_response(orjson.loads(response.content))
         except httpx.ConnectError:
             raise ConnectionError(
                 f"Cannot connect to Ollama at {self.host}. "
@@ -84,6 +177,34 @@ class LLMService:
         except Exception as e:
             raise RuntimeError(f"LLM generation failed: {e}")
     
+    async def generate_async(
+        self,
+        prompt: str,
+        temperature: float = 0.1,
+        max_tokens: int = 1024,
+        stop_sequences: Optional[list] = None
+    ) -> LLMResponse:
+        """
+        Async generate() on the shared keep-alive client. Concurrent
+        requests wait on Ollama side by side instead of blocking the
+        event loop one after another.
+        """
+        if self.circuit_open:
+            raise self._unavailable()
+        
+        payload = self._generate_payload(prompt, temperature, max_tokens, stop_sequences)
+        
+        try:
+            response = await self.async_client.post("/api/generate", json=payload)
+            self._record_success()
+            response.raise_for_status()
+            return self._to_response(orjson.loads(response.content))
+        except (httpx.ConnectError, httpx.ConnectTimeout):
+            self._record_failure()
+            raise self._unavailable()
+        except Exception as e:
+            raise RuntimeError(f"LLM generation failed: {e}")
+    
     async def generate_stream(
         self,
         prompt: str,
@@ -103,29 +224,56 @@ class LLMService:
             }
         }
         
-        async with httpx.AsyncClient(timeout=self.timeout) as client:
-            async with client.stream(
-                "POST",
-                f"{self.host}/api/generate",
-                json=payload
-            ) as response:
-                async for line in response.aiter_lines():
-                    if line:
-                        data = json.loads(line)
-                        if "response" in data:
-                            yield data["response"]
-                        if data.get("done"):
-                            break
+        if self.circuit_open:
+            raise self._unavailable()
+        
+        async with self.async_client.stream("POST", "/api/generate", json=payload) as response:
+            # Newline-delimited JSON parsed straight from bytes; a line
+            # split across reads is carried over to the next one
+            pending = b""
+            async for raw in response.aiter_bytes():
+                *lines, pending = (pending + raw).split(b"\n")
+                for line in lines:
+                    if not line:
+                        continue
+                    data = orjson.loads(line)
+                    if "response" in data:
+                        yield data["response"]
+                    if data.get("done"):
+                        return
+            
+            # The final object may arrive without a trailing newline
+            if pending.strip():
+                data = orjson.loads(pending)
+                if "response" in data:
+                    yield data["response"]
     
-    def get_available_models(self) -> list:
-        """List available Ollama models"""
+    def _cached_tags(self) -> Tuple[bool, Optional[List[str]]]:
+        """(fresh, models) from the tags cache"""
+        fetched_at, models = self._tags_cache
+        return time.monotonic() - fetched_at < TAGS_CACHE_TTL, models
+    
+    @staticmethod
+    def _parse_tags(response: httpx.Response) -> List[str]:
+        response.raise_for_status()
+        return [m["name"] for m in orjson.loads(response.content).get("models", [])]
+    
+    def _get_tags(self) -> Optional[List[str]]:
+        """Model names from /api/tags, or None if Ollama is unreachable (cached briefly)"""
+        fresh, models = self._cached_tags()
+        if fresh:
+            return models
+        
         try:
-            response = self.client.get(f"{self.host}/api/tags")
-            response.raise_for_status()
-            data = response.json()
-            return [m["name"] for m in data.get("models", [])]
+            models = self._parse_tags(self.client.get(f"{self.host}/api/tags"))
         except Exception:
-            return []
+            models = None
+        self._tags_cache = (time.monotonic(), models)
+        return models
+    
+    def get_available_models(self) -> list:
+        """List available Ollama models"""
+        return self._get_tags() or []
     
     def pull_model(self, model_name: str) -> bool:
         """Pull a model if not available"""
@@ -141,11 +289,25 @@ class LLMService:
     
     def is_available(self) -> bool:
         """Check if Ollama is running"""
+        return self._get_tags() is not None
+    
+    async def is_available_async(self, timeout: float = 0.5) -> bool:
+        """Non-blocking is_available() with a short timeout, for async endpoints"""
+        fresh, models = self._cached_tags()
+        if fresh:
+            return models is not None
+        if self.circuit_open:
+            return False
+        
         try:
-            response = self.client.get(f"{self.host}/api/tags")
-            return response.status_code == 200
+            models = self._parse_tags(await self.async_client.get("/api/tags", timeout=timeout))
         except Exception:
-            return False
+            self._record_failure()
+            models = None
+        else:
+            self._record_success()
+        self._tags_cache = (time.monotonic(), models)
+        return models is not None
 
 
 class ExtractiveLLMService(LLMService):
@@ -177,20 +339,7 @@ class ExtractiveLLMService(LLMService):
         context_chunks: list
     ) -> str:
         """Build prompt that forces extractive behavior"""
-        return f"""You are an EXTRACTIVE question answering system. You MUST follow these rules:
-
-CRITICAL RULES:
-1. Your answer MUST use EXACT QUOTES from the sources
-2. Place quotes inside "quotation marks"
-3. Add citation markers [1], [2] after each quote
-4. If you cannot find the answer in the sources, respond: "NOT_FOUND"
-5. Do NOT paraphrase - use the exact words from sources
-
-{context}
-
-QUESTION: {question}
-
-EXTRACTIVE ANSWER (quotes with citations only):"""
+        return EXTRACTIVE_PROMPT.format(context=context, question=question)
     
     def _parse_extractive_response(
         self,
@@ -198,8 +347,6 @@ EXTRACTIVE ANSWER (quotes with citations only):"""
         context_chunks: list
     ) -> Dict[str, Any]:
         """Parse the extractive response to verify quotes"""
-        import re
-        
         # Check for NOT_FOUND
         if "NOT_FOUND" in response.upper():
             return {
@@ -208,30 +355,22 @@ EXTRACTIVE ANSWER (quotes with citations only):"""
                 "quotes": []
             }
         
-        # Extract quoted passages and citations
-        quote_pattern = r'"([^"]+)"\s*\[(\d+)\]'
-        quotes = re.findall(quote_pattern, response)
+        # Lowercase each source once, not once per quote
+        lower_contents = [chunk.content.lower() for chunk in context_chunks]
         
+        # Extract quoted passages and citations
         verified_quotes = []
-        for quote, citation_num in quotes:
+        for match in _QUOTE_RE.finditer(response):
+            quote, citation_num = match.groups()
             idx = int(citation_num) - 1
             if 0 <= idx < len(context_chunks):
-                chunk = context_chunks[idx]
-                # Verify quote exists in source
-                if quote.lower() in chunk.content.lower():
-                    verified_quotes.append({
-                        "quote": quote,
-                        "citation": f"[{citation_num}]",
-                        "source": chunk.citation,
-                        "verified": True
-                    })
-                else:
-                    verified_quotes.append({
-                        "quote": quote,
-                        "citation": f"[{citation_num}]",
-                        "source": chunk.citation,
-                        "verified": False  # Quote not found in source!
-                    })
+                verified_quotes.append({
+                    "quote": quote,
+                    "citation": f"[{citation_num}]",
+                    "source": context_chunks[idx].citation,
+                    # Verify quote exists in source
+                    "verified": quote.lower() in lower_contents[idx]
+                })
         
         return {
             "answer": response,
@@ -0,0 +1,79 @@
+"""
+Query Batcher - Embeds questions from concurrent requests together
+One embed_batch call per window instead of one model call per request
+"""
+import asyncio
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from app.core.config import settings
+from app.services.embedding_service import embedding_service
+
+
+class QueryBatcher:
+    """
+    Collects query texts for up to QUERY_BATCH_WAIT_MS, or until
+    QUERY_BATCH_SIZE are waiting, then embeds them in a single batch.
+    Each caller awaits a future holding its own embedding.
+    """
+    
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    async def start(self):
+        """Start the batching loop (call from lifespan)"""
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+    
+    async def embed(self, text: str) -> np.ndarray:
+        """Embedding for one query, batched with any concurrent ones"""
+        if self._task is None:
+            # Not running under the app lifespan; embed directly
+            return await asyncio.to_thread(embedding_service.embed_text, text)
+        
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        wait = settings.QUERY_BATCH_WAIT_MS / 1000
+        
+        while True:
+            batch: List[Tuple[str, asyncio.Future]] = [await self._queue.get()]
+            deadline = loop.time() + wait
+            while len(batch) < settings.QUERY_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            try:
+                embeddings = await asyncio.to_thread(
+                    embedding_service.embed_batch, [text for text, _ in batch]
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, future), embedding in zip(batch, embeddings):
+                # The caller may have gone away (client disconnect)
+                if not future.done():
+                    future.set_result(embedding)
+
+
+# Singleton instance
+query_batcher = QueryBatcher()
@@ -2,22 +2,95 @@
 Retrieval Service - Multi-stage retrieval (BM25 + Dense + Structural)
 This is the KEY improvement over standard RAG
 """
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Optional, Tuple, Union
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
+from functools import lru_cache
 import re
-from collections import defaultdict
 
+import numpy as np
 from sqlalchemy.orm import Session
-from sqlalchemy import text as sql_text
+from sqlalchemy import Float, bindparam, text as sql_text
 
 from app.core.config import settings
-from app.core.database import get_db
+from app.core.database import get_db, GUID
 from app.models.chunk import Chunk
 from app.models.document import Document
 from app.services.vector_index_service import vector_index
 from app.services.embedding_service import embedding_service
 
 
+# Built once at import so SQLAlchemy's compiled-statement cache is keyed on
+# a single TextClause. chunks_fts is an external-content index keyed by
+# chunks.fts_rowid, so the top FTS hits are joined back to get chunk ids.
+BM25_SEARCH_SQL = sql_text("""
+    SELECT c.id AS chunk_id, f.score
+    FROM (
+        SELECT rowid, bm25(chunks_fts) AS score
+        FROM chunks_fts
+        WHERE chunks_fts MATCH :query
+        ORDER BY score
+        LIMIT :limit
+    ) AS f
+    JOIN chunks AS c ON c.fts_rowid = f.rowid
+    ORDER BY f.score
+""").columns(chunk_id=GUID(), score=Float())
+
+# Query term extraction
+_WORD_RE = re.compile(r'\b\w+\b')
+_QUERY_STOPWORDS = frozenset({
+    "the", "a", "an", "is", "are", "was", "were", "what", "how",
+    "when", "where", "why", "who", "which", "can", "could", "would",
+    "should", "do", "does", "did", "have", "has", "had", "be", "been",
+    "being", "for", "to", "of", "in", "on", "at", "by", "with"
+})
+
+# Runs retrieve()'s FAISS search while the calling thread does the BM25
+# query. The search needs no DB session, and FAISS releases the GIL.
+_dense_search_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="dense-search")
+
+# How many FTS hits to take per result slot when filters are pushed into SQL
+BM25_FILTER_OVERFETCH = 10
+
+
+@lru_cache(maxsize=None)
+def bm25_filtered_sql(by_document: bool, by_category: bool):
+    """
+    BM25_SEARCH_SQL with the document/category/reliability filters applied
+    in SQL. The FTS hits are still taken first in their own subquery (its
+    LIMIT keeps SQLite from flattening it), so the MATCH runs on the FTS5
+    index and only the overfetched hits are joined to documents; a direct
+    join lets the planner drive from documents and scan the FTS table.
+    One statement per filter combination.
+    """
+    conditions = ["d.reliability_score >= :min_reliability"]
+    if by_document:
+        conditions.append("d.id IN :document_ids")
+    if by_category:
+        conditions.append("d.category IN :categories")
+    
+    statement = sql_text(f"""
+        SELECT c.id AS chunk_id, f.score
+        FROM (
+            SELECT rowid, bm25(chunks_fts) AS score
+            FROM chunks_fts
+            WHERE chunks_fts MATCH :query
+            ORDER BY score
+            LIMIT :overfetch
+        ) AS f
+        JOIN chunks AS c ON c.fts_rowid = f.rowid
+        JOIN documents AS d ON d.id = c.document_id
+        WHERE {" AND ".join(conditions)}
+        ORDER BY f.score
+        LIMIT :limit
+    """)
+    if by_document:
+        statement = statement.bindparams(bindparam("document_ids", expanding=True, type_=GUID()))
+    if by_category:
+        statement = statement.bindparams(bindparam("categories", expanding=True))
+    return statement.columns(chunk_id=GUID(), score=Float())
+
+
 @dataclass
 class RetrievedChunk:
     """A retrieved chunk with scoring metadata"""
@@ -28,6 +101,7 @@ class RetrievedChunk:
     page_number: Optional[int]
     section_title: Optional[str]
     chunk_type: str
+    sequence_index: Optional[int] = None
     
     # Scoring breakdown
     bm25_score: float = 0.0
@@ -37,6 +111,29 @@ class RetrievedChunk:
     
     # For grounding
     confidence_weight: float = 1.0
+    
+    # Full-content hash stored at ingestion, used for deduplication
+    content_hash: Optional[str] = None
+
+
+def top_k_indices(scores: np.ndarray, k: Optional[int] = None) -> np.ndarray:
+    """
+    Positions of the k highest scores, best first. Selects with
+    np.argpartition (O(n)) and only sorts the k survivors.
+    """
+    if k is None or k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+
+def top_k_by_score(chunks: List[RetrievedChunk], k: Optional[int] = None) -> List[RetrievedChunk]:
+    """The k highest final_score chunks, best first"""
+    scores = np.fromiter((c.final_score for c in chunks), dtype=np.float64, count=len(chunks))
+    return [chunks[i] for i in top_k_indices(scores, k)]
 
 
 class RetrievalService:
@@ -58,56 +155,98 @@ class RetrievalService:
         document_ids: Optional[List[str]] = None,
         categories: Optional[List[str]] = None,
         min_reliability: float = 0.5,
-        top_k: int = 10
+        top_k: int = 10,
+        query_embedding: Optional[np.ndarray] = None
     ) -> List[RetrievedChunk]:
         """
         Main retrieval entry point.
         Returns top-K chunks with combined scoring.
+        Pass query_embedding when the query was already embedded (e.g. by
+        the query batcher) to skip embedding it again.
+        """
+        # Dense semantic search runs in the background while the BM25 leg
+        # runs here; the rest of the pipeline is shared with retrieve_batch()
+        dense_future = _dense_search_pool.submit(
+            vector_index.search,
+            query, top_k=settings.TOP_K_RETRIEVAL * 2, query_embedding=query_embedding
+        )
+        return self._retrieve_with_dense(
+            query, dense_future, document_ids, categories, min_reliability, top_k
+        )
+    
+    def retrieve_batch(
+        self,
+        queries: List[str],
+        document_ids: Optional[List[str]] = None,
+        categories: Optional[List[str]] = None,
+        min_reliability: float = 0.5,
+        top_k: int = 10,
+        query_embeddings: Optional[np.ndarray] = None
+    ) -> List[List[RetrievedChunk]]:
         """
+        retrieve() for several queries sharing the same filters. The queries
+        are embedded in one batch and searched with one FAISS call.
+        """
+        dense_batch = vector_index.search_batch(
+            queries, top_k=settings.TOP_K_RETRIEVAL * 2, query_embeddings=query_embeddings
+        )
+        return [
+            self._retrieve_with_dense(
+                query, dense_results, document_ids, categories, min_reliability, top_k
+            )
+            for query, dense_results in zip(queries, dense_batch)
+        ]
+    
+    def _retrieve_with_dense(
+        self,
+        query: str,
+        dense_results: Union[List[Tuple[str, float]], Future],
+        document_ids: Optional[List[str]],
+        categories: Optional[List[str]],
+        min_reliability: float,
+        top_k: int
+    ) -> List[RetrievedChunk]:
+        """The retrieval pipeline around the dense search (or its pending result)"""
         # Step 1: Query expansion (extract key terms)
         query_terms = self._extract_query_terms(query)
         
         # Step 2: BM25 keyword search (fast filtering)
-        bm25_results = self._bm25_search(query_terms, limit=settings.TOP_K_RETRIEVAL * 2)
+        bm25_results = self._bm25_search(
+            query_terms, limit=settings.TOP_K_RETRIEVAL * 2,
+            document_ids=document_ids, categories=categories, min_reliability=min_reliability
+        )
         
-        # Step 3: Dense semantic search
-        dense_results = vector_index.search(query, top_k=settings.TOP_K_RETRIEVAL * 2)
+        # Step 3: Merge candidates into one score table
+        if isinstance(dense_results, Future):
+            dense_results = dense_results.result()
+        rows, scores = self._merge_results(bm25_results, dense_results)
         
-        # Step 4: Merge and score candidates
-        candidates = self._merge_results(bm25_results, dense_results)
-        
-        # Step 5: Filter by document/category constraints
-        if document_ids or categories or min_reliability > 0:
-            candidates = self._filter_candidates(
-                candidates, document_ids, categories, min_reliability
-            )
-        
-        # Step 6: Structural re-ranking (boost headings, exact matches)
-        results = self._structural_rerank(candidates, query, query_terms)
-        
-        # Step 7: Return top-K
-        return sorted(results, key=lambda x: x.final_score, reverse=True)[:top_k]
+        # Step 4: Load candidates, filtered by document/category constraints
+        # (the BM25 hits already are; this drops dense hits from other
+        # documents), re-rank with structural signals and return top-K
+        return self._fetch_and_rerank(
+            rows, scores, query, query_terms, top_k, document_ids, categories, min_reliability
+        )
     
     def _extract_query_terms(self, query: str) -> List[str]:
         """Extract important terms from query for BM25"""
         # Remove stopwords and extract key terms
-        stopwords = {"the", "a", "an", "is", "are", "was", "were", "what", "how", 
-                     "when", "where", "why", "who", "which", "can", "could", "would",
-                     "should", "do", "does", "did", "have", "has", "had", "be", "been",
-                     "being", "for", "to", "of", "in", "on", "at", "by", "with"}
-        
-        words = re.findall(r'\b\w+\b', query.lower())
-        terms = [w for w in words if w not in stopwords and len(w) > 2]
+        words = _WORD_RE.findall(query.lower())
+        terms = [w for w in words if w not in _QUERY_STOPWORDS and len(w) > 2]
         return terms
     
     def _bm25_search(
         self, 
         query_terms: List[str], 
-        limit: int = 50
+        limit: int = 50,
+        document_ids: Optional[List[str]] = None,
+        categories: Optional[List[str]] = None,
+        min_reliability: float = 0.0
     ) -> Dict[str, float]:
         """
         BM25 search using SQLite FTS5.
-        Returns dict of chunk_id -> BM25 score.
+        Returns dict of chunk_id -> BM25 score, normalized so the best hit is 1.
+        With filters, only hits from matching documents are returned.
         """
         if not query_terms:
             return {}
@@ -116,148 +255,152 @@ class RetrievalService:
         fts_query = " OR ".join(query_terms)
         
         try:
-            result = self.db.execute(sql_text("""
-                SELECT chunk_id, bm25(chunks_fts) as score
-                FROM chunks_fts
-                WHERE chunks_fts MATCH :query
-                ORDER BY score
-                LIMIT :limit
-            """), {"query": fts_query, "limit": limit})
+            if document_ids or categories or min_reliability > 0:
+                statement = bm25_filtered_sql(bool(document_ids), bool(categories))
+                params = {
+                    "query": fts_query,
+                    "limit": limit,
+                    "overfetch": limit * BM25_FILTER_OVERFETCH,
+                    "min_reliability": min_reliability
+                }
+                if document_ids:
+                    params["document_ids"] = list(document_ids)
+                if categories:
+                    params["categories"] = list(categories)
+                result = self.db.execute(statement, params)
+            else:
+                result = self.db.execute(BM25_SEARCH_SQL, {"query": fts_query, "limit": limit})
             
-            return {row.chunk_id: abs(row.score) for row in result}
+            rows = result.all()
         except Exception as e:
             # FTS table might not exist or be populated
             print(f"BM25 search error: {e}")
             return {}
+        
+        # SQLite has already selected the top hits, best (most negative
+        # bm25) first, so the first row holds the max for normalization
+        if not rows or rows[0].score >= 0:
+            return {}
+        top = -rows[0].score
+        return {row.chunk_id: -row.score / top for row in rows}
     
     def _merge_results(
         self,
         bm25_results: Dict[str, float],
         dense_results: List[Tuple[str, float]]
-    ) -> Dict[str, Dict[str, float]]:
+    ) -> Tuple[Dict[str, int], np.ndarray]:
         """
         Merge BM25 and dense results with normalized scores.
-        Returns dict of chunk_id -> {bm25_score, dense_score}
+        Returns (chunk_id -> row, scores) where scores[row] is
+        [bm25_score, dense_score].
         """
-        candidates = defaultdict(lambda: {"bm25_score": 0.0, "dense_score": 0.0})
-        
-        # Normalize BM25 scores
-        if bm25_results:
-            max_bm25 = max(bm25_results.values())
-            for chunk_id, score in bm25_results.items():
-                candidates[chunk_id]["bm25_score"] = score / max_bm25 if max_bm25 > 0 else 0
-        
-        # Dense scores are already 0-1 (cosine similarity)
-        for chunk_id, score in dense_results:
-            candidates[chunk_id]["dense_score"] = score
-        
-        return dict(candidates)
-    
-    def _filter_candidates(
-        self,
-        candidates: Dict[str, Dict[str, float]],
-        document_ids: Optional[List[str]],
-        categories: Optional[List[str]],
-        min_reliability: float
-    ) -> Dict[str, Dict[str, float]]:
-        """Filter candidates by document/category constraints"""
-        if not candidates:
-            return {}
+        # BM25 hits take the first rows; dense-only hits follow
+        rows = {chunk_id: i for i, chunk_id in enumerate(bm25_results)}
+        for chunk_id, _ in dense_results:
+            rows.setdefault(chunk_id, len(rows))
         
-        # Get chunk metadata
-        chunk_ids = list(candidates.keys())
-        chunks = self.db.query(Chunk).filter(Chunk.id.in_(chunk_ids)).all()
+        scores = np.zeros((len(rows), 2))
         
-        doc_ids = {c.document_id for c in chunks}
-        docs = {d.id: d for d in self.db.query(Document).filter(Document.id.in_(doc_ids)).all()}
+        # BM25 scores come normalized from _bm25_search
+        scores[:len(bm25_results), 0] = list(bm25_results.values())
         
-        filtered = {}
-        for chunk in chunks:
-            doc = docs.get(chunk.document_id)
-            if not doc:
-                continue
-            
-            # Check constraints
-            if document_ids and doc.id not in document_ids:
-                continue
-            if categories and doc.category not in categories:
-                continue
-            if doc.reliability_score < min_reliability:
-                continue
-            
-            filtered[chunk.id] = candidates[chunk.id]
+        # Dense scores are already 0-1 (cosine similarity)
+        if dense_results:
+            dense_ids, dense_scores = zip(*dense_results)
+            scores[[rows[chunk_id] for chunk_id in dense_ids], 1] = dense_scores
         
-        return filtered
+        return rows, scores
     
-    def _structural_rerank(
+    def _fetch_and_rerank(
         self,
-        candidates: Dict[str, Dict[str, float]],
+        rows: Dict[str, int],
+        scores: np.ndarray,
         query: str,
-        query_terms: List[str]
+        query_terms: List[str],
+        top_k: int,
+        document_ids: Optional[List[str]] = None,
+        categories: Optional[List[str]] = None,
+        min_reliability: float = 0.0
     ) -> List[RetrievedChunk]:
         """
-        Apply structural signals and compute final scores.
+        Load the candidates with their documents in one joined query,
+        dropping those outside the document/category/reliability filters,
+        then apply structural signals and return the top_k by final score.
         Boosts:
         - Headings that match query terms
         - Exact phrase matches
         - Higher confidence weights
         """
-        if not candidates:
+        if not rows:
             return []
         
-        chunk_ids = list(candidates.keys())
-        chunks = self.db.query(Chunk).filter(Chunk.id.in_(chunk_ids)).all()
-        
-        # Get document info
-        doc_ids = {c.document_id for c in chunks}
-        docs = {d.id: d for d in self.db.query(Document).filter(Document.id.in_(doc_ids)).all()}
+        joined = (
+            self.db.query(Chunk, Document)
+            .join(Document, Chunk.document_id == Document.id)
+            .filter(Chunk.id.in_(list(rows)))
+        )
+        if document_ids:
+            joined = joined.filter(Document.id.in_(document_ids))
+        if categories:
+            joined = joined.filter(Document.category.in_(categories))
+        if min_reliability > 0:
+            joined = joined.filter(Document.reliability_score >= min_reliability)
+        loaded = joined.all()
+        if not loaded:
+            return []
         
-        results = []
+        # Only the text checks need Python; the weighting is vectorized
         query_lower = query.lower()
+        structural = np.zeros(len(loaded))
+        doc_boost = np.empty(len(loaded))
+        positions = np.empty(len(loaded), dtype=np.intp)
         
-        for chunk in chunks:
-            scores = candidates.get(chunk.id, {})
-            doc = docs.get(chunk.document_id)
-            
-            # Compute structural score
-            structural_score = 0.0
+        for i, (chunk, doc) in enumerate(loaded):
+            positions[i] = rows[chunk.id]
             content_lower = chunk.content.lower()
             
             # Boost for exact query match
             if query_lower in content_lower:
-                structural_score += 0.5
+                structural[i] += 0.5
             
             # Boost for term coverage
             term_coverage = sum(1 for t in query_terms if t in content_lower) / max(len(query_terms), 1)
-            structural_score += term_coverage * 0.3
+            structural[i] += term_coverage * 0.3
             
             # Boost headings
             if chunk.chunk_type == "heading":
-                structural_score += 0.2
+                structural[i] += 0.2
             
             # Apply confidence weight from document
-            doc_boost = (doc.reliability_score if doc else 1.0) * chunk.confidence_weight
-            
-            # Compute final weighted score
-            final_score = (
-                settings.BM25_WEIGHT * scores.get("bm25_score", 0) +
-                settings.DENSE_WEIGHT * scores.get("dense_score", 0) +
-                settings.STRUCTURAL_WEIGHT * structural_score
-            ) * doc_boost
-            
+            doc_boost[i] = doc.reliability_score * chunk.confidence_weight
+        
+        # Compute final weighted scores
+        bm25, dense = scores[positions].T
+        final = (
+            settings.BM25_WEIGHT * bm25 +
+            settings.DENSE_WEIGHT * dense +
+            settings.STRUCTURAL_WEIGHT * structural
+        ) * doc_boost
+        
+        # Build result objects for the top-K only
+        results = []
+        for i in top_k_indices(final, top_k).tolist():
+            chunk, doc = loaded[i]
             results.append(RetrievedChunk(
                 chunk_id=chunk.id,
                 content=chunk.content,
                 document_id=chunk.document_id,
-                document_name=doc.filename if doc else "Unknown",
+                document_name=doc.filename,
                 page_number=chunk.page_number,
                 section_title=chunk.section_title,
                 chunk_type=chunk.chunk_type,
-                bm25_score=scores.get("bm25_score", 0),
-                dense_score=scores.get("dense_score", 0),
-                structural_score=structural_score,
-                final_score=final_score,
-                confidence_weight=chunk.confidence_weight
+                sequence_index=chunk.sequence_index,
+                bm25_score=float(bm25[i]),
+                dense_score=float(dense[i]),
+                structural_score=float(structural[i]),
+                final_score=float(final[i]),
+                confidence_weight=chunk.confidence_weight,
+                content_hash=chunk.content_hash
             ))
         
         return results
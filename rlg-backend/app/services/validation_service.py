@@ -5,13 +5,27 @@ THE KEY to near-zero hallucination
 from typing import List, Dict, Optional, Tuple
 from dataclasses import dataclass
 import re
-from difflib import SequenceMatcher
+
+import numpy as np
 
 from app.services.context_service import ContextChunk
 from app.services.embedding_service import embedding_service
 from app.core.config import settings
 
 
+# Patterns compiled once at import
+# Line breaks, or whitespace after . ? ! (skipping "e.g.", "Mr.")
+_SENTENCE_BOUNDARY = re.compile(r'\n|(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?|\!)\s')
+_CITATION_MARKER = re.compile(r'\[(\d+)\]')
+_WORD = re.compile(r'\b\w+\b')
+
+_STOPWORDS = frozenset({
+    "the", "a", "an", "is", "are", "was", "were", "be", "been",
+    "to", "of", "in", "for", "on", "with", "at", "by", "from",
+    "this", "that", "these", "those", "it", "its"
+})
+
+
 @dataclass
 class GroundingResult:
     """Result of grounding validation for a sentence"""
@@ -23,6 +37,25 @@ class GroundingResult:
     match_type: str  # exact, paraphrase, inferred, ungrounded
 
 
+@dataclass
+class _PreparedChunk:
+    """A context chunk with the lowercased text and word sets matching needs"""
+    chunk: ContextChunk
+    content_lower: str
+    words: frozenset  # Content words without stopwords, for fuzzy scoring
+    _excerpts: Optional[List[Tuple[str, frozenset]]] = None
+    
+    @property
+    def excerpts(self) -> List[Tuple[str, frozenset]]:
+        """(sentence, word set) for each sentence of the content, split on first use"""
+        if self._excerpts is None:
+            self._excerpts = [
+                (excerpt, frozenset(_WORD.findall(excerpt.lower())))
+                for excerpt in ValidationService._split_sentences(self.chunk.content)
+            ]
+        return self._excerpts
+
+
 @dataclass
 class ValidationResult:
     """Overall validation result for an answer"""
@@ -67,17 +100,34 @@ class ValidationService:
         # Split answer into sentences
         sentences = self._split_sentences(answer)
         
-        # Build content index for fast matching
-        content_index = {
-            chunk.chunk_id: chunk.content.lower()
-            for chunk in context_chunks
-        }
-        
-        # Validate each sentence
-        sentence_results = []
-        for sentence in sentences:
-            result = self._validate_sentence(sentence, context_chunks, content_index)
-            sentence_results.append(result)
+        # Lowercase and tokenize each chunk once for the whole answer
+        prepared = []
+        for chunk in context_chunks:
+            content_lower = chunk.content.lower()
+            words = frozenset(_WORD.findall(content_lower)) - _STOPWORDS
+            prepared.append(_PreparedChunk(chunk, content_lower, words))
+        
+        # Sentences without citations are tried against the text first;
+        # only those left over (and cited ones) need embeddings
+        sentence_results: List[Optional[GroundingResult]] = [None] * len(sentences)
+        text_matches: Dict[int, Tuple[Optional[GroundingResult], float]] = {}
+        pending = []
+        for i, sentence in enumerate(sentences):
+            if not _CITATION_MARKER.search(sentence):
+                text_matches[i] = self._match_text(sentence, prepared)
+                if text_matches[i][0] is not None:
+                    sentence_results[i] = text_matches[i][0]
+                    continue
+            pending.append(i)
+        
+        if pending:
+            # Similarities for the remaining sentences: two batched embedding
+            # calls and one matmul, shape [sentences, chunks]
+            similarities = self._similarity_matrix([sentences[i] for i in pending], context_chunks)
+            for i, row in zip(pending, similarities):
+                sentence_results[i] = self._validate_sentence(
+                    sentences[i], prepared, row, text_matches.get(i)
+                )
         
         # Compute overall score
         grounded_count = sum(1 for r in sentence_results if r.is_grounded)
@@ -98,7 +148,7 @@ class ValidationService:
             errors.append("Less than 50% of the answer is grounded in sources")
         
         # Check for citation markers
-        if not re.search(r'\[\d+\]', answer):
+        if not _CITATION_MARKER.search(answer):
             warnings.append("Answer contains no citation markers")
         
         return ValidationResult(
@@ -109,101 +159,62 @@ class ValidationService:
             errors=errors
         )
     
-    def _split_sentences(self, text: str) -> List[str]:
+    @staticmethod
+    def _split_sentences(text: str) -> List[str]:
         """Split text into sentences"""
-        # Handle common abbreviations
-        text = re.sub(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?|\!)\s', '\n', text)
-        sentences = [s.strip() for s in text.split('\n') if s.strip()]
-        return sentences
+        return [s for part in _SENTENCE_BOUNDARY.split(text) if (s := part.strip())]
     
     def _validate_sentence(
         self,
         sentence: str,
-        context_chunks: List[ContextChunk],
-        content_index: Dict[str, str]
+        chunks: List[_PreparedChunk],
+        similarities: np.ndarray,
+        text_match: Optional[Tuple[Optional[GroundingResult], float]] = None
     ) -> GroundingResult:
         """
         Validate a single sentence against sources.
-        Uses multiple matching strategies.
+        Uses multiple matching strategies. `similarities` holds the
+        sentence's semantic similarity to each context chunk; `text_match`
+        is the _match_text() result if it was already computed.
         """
-        sentence_lower = sentence.lower()
-        
         # Strategy 1: Check for citation markers and verify
-        citations = re.findall(r'\[(\d+)\]', sentence)
+        citations = _CITATION_MARKER.findall(sentence)
         if citations:
             for citation_num in citations:
                 idx = int(citation_num) - 1
-                if 0 <= idx < len(context_chunks):
-                    chunk = context_chunks[idx]
+                if 0 <= idx < len(chunks):
+                    chunk = chunks[idx]
                     # Check if sentence content relates to cited chunk
-                    similarity = self._semantic_similarity(
-                        sentence, chunk.content
-                    )
+                    similarity = float(similarities[idx])
                     if similarity > 0.5:
                         return GroundingResult(
                             sentence=sentence,
                             is_grounded=True,
                             confidence=similarity,
-                            matched_chunks=[chunk.chunk_id],
-                            matched_excerpts=[self._find_matching_excerpt(sentence, chunk.content)],
+                            matched_chunks=[chunk.chunk.chunk_id],
+                            matched_excerpts=[self._find_matching_excerpt(sentence, chunk)],
                             match_type="cited"
                         )
         
-        # Strategy 2: Exact substring match
-        for chunk_id, content in content_index.items():
-            # Remove citation markers for matching
-            clean_sentence = re.sub(r'\[\d+\]', '', sentence_lower).strip()
-            
-            if len(clean_sentence) > 20 and clean_sentence in content:
-                return GroundingResult(
-                    sentence=sentence,
-                    is_grounded=True,
-                    confidence=1.0,
-                    matched_chunks=[chunk_id],
-                    matched_excerpts=[clean_sentence],
-                    match_type="exact"
-                )
-        
-        # Strategy 3: Fuzzy matching for paraphrases
-        best_match_chunk = None
-        best_match_score = 0.0
-        best_excerpt = ""
-        
-        for chunk in context_chunks:
-            score = self._fuzzy_match_score(sentence, chunk.content)
-            if score > best_match_score:
-                best_match_score = score
-                best_match_chunk = chunk.chunk_id
-                best_excerpt = self._find_matching_excerpt(sentence, chunk.content)
-        
-        if best_match_score > 0.6:
-            return GroundingResult(
-                sentence=sentence,
-                is_grounded=True,
-                confidence=best_match_score,
-                matched_chunks=[best_match_chunk] if best_match_chunk else [],
-                matched_excerpts=[best_excerpt] if best_excerpt else [],
-                match_type="paraphrase"
-            )
+        # Strategies 2 and 3: exact and fuzzy text matching
+        if text_match is None:
+            text_match = self._match_text(sentence, chunks)
+        text_result, best_match_score = text_match
+        if text_result is not None:
+            return text_result
         
         # Strategy 4: Semantic similarity via embeddings
-        best_semantic_chunk = None
-        best_semantic_score = 0.0
-        best_semantic_excerpt = ""
-        
-        for chunk in context_chunks:
-            score = self._semantic_similarity(sentence, chunk.content)
-            if score > best_semantic_score:
-                best_semantic_score = score
-                best_semantic_chunk = chunk.chunk_id
-                best_semantic_excerpt = self._find_matching_excerpt(sentence, chunk.content)
+        best = int(similarities.argmax())
+        best_semantic_score = float(similarities[best])
         
         if best_semantic_score > 0.7:
+            best_semantic_chunk = chunks[best]
+            best_semantic_excerpt = self._find_matching_excerpt(sentence, best_semantic_chunk)
             return GroundingResult(
                 sentence=sentence,
                 is_grounded=True,
                 confidence=best_semantic_score,
-                matched_chunks=[best_semantic_chunk] if best_semantic_chunk else [],
+                matched_chunks=[best_semantic_chunk.chunk.chunk_id],
                 matched_excerpts=[best_semantic_excerpt] if best_semantic_excerpt else [],
                 match_type="inferred"
             )
@@ -218,58 +229,86 @@ class ValidationService:
             match_type="ungrounded"
         )
     
-    def _fuzzy_match_score(self, sentence: str, content: str) -> float:
-        """Compute fuzzy string matching score"""
-        sentence_lower = re.sub(r'\[\d+\]', '', sentence.lower()).strip()
-        content_lower = content.lower()
+    def _match_text(
+        self,
+        sentence: str,
+        chunks: List[_PreparedChunk]
+    ) -> Tuple[Optional[GroundingResult], float]:
+        """
+        Strategies 2 and 3, which need no embeddings. Returns the exact or
+        paraphrase match if there is one, and the best fuzzy score.
+        """
+        # One pass over the chunks: an exact substring match (ignoring
+        # citation markers) returns at once, otherwise the best fuzzy
+        # word-overlap score is kept for paraphrases
+        clean_sentence = _CITATION_MARKER.sub('', sentence.lower()).strip()
+        check_exact = len(clean_sentence) > 20
+        sentence_words = frozenset(_WORD.findall(clean_sentence)) - _STOPWORDS
+        
+        best_match: Optional[_PreparedChunk] = None
+        best_match_score = 0.0
         
-        # Check for significant word overlap
-        sentence_words = set(re.findall(r'\b\w+\b', sentence_lower))
-        content_words = set(re.findall(r'\b\w+\b', content_lower))
+        for chunk in chunks:
+            if check_exact and clean_sentence in chunk.content_lower:
+                return GroundingResult(
+                    sentence=sentence,
+                    is_grounded=True,
+                    confidence=1.0,
+                    matched_chunks=[chunk.chunk.chunk_id],
+                    matched_excerpts=[clean_sentence],
+                    match_type="exact"
+                ), 1.0
+            
+            score = self._fuzzy_match_score(sentence_words, chunk.words)
+            if score > best_match_score:
+                best_match_score = score
+                best_match = chunk
         
-        # Remove stopwords
-        stopwords = {"the", "a", "an", "is", "are", "was", "were", "be", "been",
-                     "to", "of", "in", "for", "on", "with", "at", "by", "from",
-                     "this", "that", "these", "those", "it", "its"}
-        sentence_words -= stopwords
-        content_words -= stopwords
+        if best_match_score > 0.6:
+            best_excerpt = self._find_matching_excerpt(sentence, best_match)
+            return GroundingResult(
+                sentence=sentence,
+                is_grounded=True,
+                confidence=best_match_score,
+                matched_chunks=[best_match.chunk.chunk_id],
+                matched_excerpts=[best_excerpt] if best_excerpt else [],
+                match_type="paraphrase"
+            ), best_match_score
         
+        return None, best_match_score
+    
+    @staticmethod
+    def _fuzzy_match_score(sentence_words: frozenset, content_words: frozenset) -> float:
+        """Share of the sentence's non-stopword words that appear in the content"""
         if not sentence_words:
             return 0.0
-        
-        overlap = len(sentence_words & content_words)
-        score = overlap / len(sentence_words)
-        
-        return score
+        return len(sentence_words & content_words) / len(sentence_words)
     
-    def _semantic_similarity(self, text1: str, text2: str) -> float:
-        """Compute semantic similarity using embeddings"""
-        import numpy as np
-        
-        emb1 = embedding_service.embed_text(text1)
-        emb2 = embedding_service.embed_text(text2)
+    def _similarity_matrix(
+        self,
+        sentences: List[str],
+        context_chunks: List[ContextChunk]
+    ) -> np.ndarray:
+        """Cosine similarity of every sentence to every chunk, clipped to [0, 1]"""
+        sentence_embs = embedding_service.embed_batch(sentences)
+        chunk_embs = embedding_service.embed_batch([c.content for c in context_chunks])
         
-        # Cosine similarity (already normalized)
-        similarity = float(np.dot(emb1, emb2))
-        return max(0.0, min(1.0, similarity))
+        # Embeddings are normalized, so the matmul gives cosine similarity
+        return np.clip(sentence_embs @ chunk_embs.T, 0.0, 1.0)
     
     def _find_matching_excerpt(
         self,
         sentence: str,
-        content: str,
+        chunk: _PreparedChunk,
         max_length: int = 200
     ) -> str:
         """Find the most relevant excerpt from content that matches sentence"""
-        sentence_words = set(re.findall(r'\b\w+\b', sentence.lower()))
-        
-        # Split content into sentences
-        content_sentences = self._split_sentences(content)
+        sentence_words = set(_WORD.findall(sentence.lower()))
         
         best_excerpt = ""
         best_score = 0
         
-        for excerpt in content_sentences:
-            excerpt_words = set(re.findall(r'\b\w+\b', excerpt.lower()))
+        for excerpt, excerpt_words in chunk.excerpts:
             overlap = len(sentence_words & excerpt_words)
             if overlap > best_score:
                 best_score = overlap
@@ -3,8 +3,10 @@ Vector Index Service - FAISS-based local vector search
 Maintains persistent indices for fast retrieval
 """
 import numpy as np
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Tuple, Optional
+from typing import Dict, List, Tuple, Optional, Set
+import os
 import pickle
 import threading
 
@@ -12,6 +14,13 @@ from app.core.config import settings
 from app.services.embedding_service import embedding_service
 
 
+# Largest k FAISS GPU indexes can search for
+GPU_MAX_K = 2048
+
+# Vectors sampled to train int8 ranges
+SQ_TRAIN_SAMPLE = 65_536
+
+
 class VectorIndexService:
     """
     FAISS-based vector index for semantic search.
@@ -34,10 +43,36 @@ class VectorIndexService:
             return
         
         self.index_path = settings.INDEX_DIR / "faiss.index"
-        self.mapping_path = settings.INDEX_DIR / "chunk_mapping.pkl"
+        self.mapping_path = settings.INDEX_DIR / "chunk_ids.npy"
+        self.legacy_mapping_path = settings.INDEX_DIR / "chunk_mapping.pkl"
         
+        # The FAISS index stores each vector under an int64 id, so chunks
+        # can be removed in place instead of rebuilding the index
         self.index = None
-        self.chunk_ids: List[str] = []  # Maps index position to chunk_id
+        self.chunk_ids: Dict[int, str] = {}   # FAISS id -> chunk_id
+        self._faiss_ids: Dict[str, int] = {}  # chunk_id -> FAISS id
+        self._next_id = 0
+        self._mmapped = False  # Index storage is a read-only view of the file
+        
+        # HNSW graphs can't drop nodes, so removed vectors stay in the index
+        # as tombstones that searches skip until rebuild() compacts them
+        self._removed: Set[int] = set()
+        self._removed_filter = None  # (IDSelectorNot, IDSelectorBatch) while _removed
+        
+        # GPU copy for large batched searches, created on first use and
+        # dropped whenever the CPU index (the source of truth) changes
+        self._gpu_resources = None
+        self._gpu_index = None
+        self._gpu_unavailable = False
+        
+        # Mutations (add/remove/rebuild/save) are serialized by _write_lock.
+        # Searches run in several threads and don't take it; they only wait
+        # out the short in-place writes to the FAISS index, which can
+        # reallocate its storage under a running scan (see _modifying_index)
+        self._write_lock = threading.RLock()
+        self._searches = 0
+        self._writer_waiting = False
+        self._search_state = threading.Condition()
         
         self._load_or_create_index()
         self._initialized = True
@@ -51,101 +86,455 @@ class VectorIndexService:
         
         if self.index_path.exists() and self.mapping_path.exists():
             # Load existing
-            self.index = faiss.read_index(str(self.index_path))
-            with open(self.mapping_path, "rb") as f:
-                self.chunk_ids = pickle.load(f)
+            self._read_index()
+            self._set_mapping(self._read_mapping())
+        elif self.index_path.exists() and self.legacy_mapping_path.exists():
+            # Pickled mapping from older versions, rewritten as .npy
+            self._read_index()
+            with open(self.legacy_mapping_path, "rb") as f:
+                mapping = pickle.load(f)
+            if isinstance(mapping, list):
+                self._migrate_positional(mapping)
+            else:
+                self._set_mapping(mapping)
+                self._save_index()
+            self.legacy_mapping_path.unlink()
+        
+        if self.index is not None:
+            if hasattr(self._base_index, "hnsw"):
+                self._base_index.hnsw.efSearch = settings.HNSW_EF_SEARCH
             print(f"✓ Loaded FAISS index with {self.index.ntotal} vectors")
+            self._maybe_promote()
         else:
             # Create new index
-            self.index = faiss.IndexFlatIP(settings.EMBEDDING_DIMENSION)  # Inner product (cosine sim for normalized vectors)
-            self.chunk_ids = []
+            self.index = self._build_index()
+            self._set_mapping({})
             print("✓ Created new FAISS index")
     
-    def add_chunks(self, chunk_ids: List[str], contents: List[str]):
-        """Add chunks to the index"""
-        if not chunk_ids or not contents:
-            return
+    def _read_index(self):
+        """
+        Open the saved index. With VECTOR_INDEX_MMAP the vector storage is
+        memory-mapped read-only, so startup doesn't copy it into RAM and
+        pages are loaded by searches as needed; the first write loads it
+        fully (see _ensure_writable).
+        """
+        import faiss
         
-        # Generate embeddings
-        embeddings = embedding_service.embed_batch(contents)
+        if settings.VECTOR_INDEX_MMAP:
+            flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+            self.index = faiss.read_index(str(self.index_path), flags)
+            self._mmapped = True
+        else:
+            self.index = faiss.read_index(str(self.index_path))
+            self._mmapped = False
+    
+    def _ensure_writable(self):
+        """Load a memory-mapped index into RAM before modifying it in place"""
+        with self._write_lock:
+            if self._mmapped:
+                import faiss
+                
+                self.index = faiss.read_index(str(self.index_path))
+                self._mmapped = False
+                if hasattr(self._base_index, "hnsw"):
+                    self._base_index.hnsw.efSearch = settings.HNSW_EF_SEARCH
+    
+    @contextmanager
+    def _searching(self):
+        """Register a search, waiting while an in-place write is pending"""
+        with self._search_state:
+            self._search_state.wait_for(lambda: not self._writer_waiting)
+            self._searches += 1
+        try:
+            yield
+        finally:
+            with self._search_state:
+                self._searches -= 1
+                self._search_state.notify_all()
+    
+    @contextmanager
+    def _modifying_index(self):
+        """
+        Exclusive use of the live index for an in-place write (call with
+        _write_lock held). New searches wait, running ones finish first.
+        """
+        with self._search_state:
+            self._writer_waiting = True
+            try:
+                self._search_state.wait_for(lambda: self._searches == 0)
+                yield
+            finally:
+                self._writer_waiting = False
+                self._search_state.notify_all()
+    
+    def _get_gpu_index(self):
+        """
+        GPU copy of the index, or None without a GPU build/device or for
+        index types FAISS can't move to GPU (fp16 flat storage, HNSW)
+        """
+        if self._gpu_index is None and not self._gpu_unavailable:
+            import faiss
+            
+            if faiss.get_num_gpus() > 0:
+                try:
+                    if self._gpu_resources is None:
+                        self._gpu_resources = faiss.StandardGpuResources()
+                    self._gpu_index = faiss.index_cpu_to_gpu(self._gpu_resources, 0, self.index)
+                except Exception as e:
+                    print(f"GPU search disabled for this index: {e}")
+            self._gpu_unavailable = self._gpu_index is None
+        return self._gpu_index
+    
+    def _read_mapping(self) -> Dict[int, str]:
+        """FAISS id -> chunk_id from the (faiss_id, chunk_id) record array"""
+        records = np.load(self.mapping_path, mmap_mode="r")
+        return dict(zip(records["faiss_id"].tolist(), np.char.decode(records["chunk_id"]).tolist()))
+    
+    def _set_mapping(self, chunk_ids: Dict[int, str]):
+        """Adopt a mapping for the loaded index; stored ids it lacks are tombstones"""
+        import faiss
         
-        # Add to FAISS
-        self.index.add(embeddings.astype(np.float32))
-        self.chunk_ids.extend(chunk_ids)
+        self.chunk_ids = chunk_ids
+        self._faiss_ids = {chunk_id: faiss_id for faiss_id, chunk_id in chunk_ids.items()}
         
-        # Persist
+        stored_ids = faiss.vector_to_array(self.index.id_map)
+        live_ids = np.fromiter(chunk_ids, dtype=np.int64, count=len(chunk_ids))
+        self._set_removed(np.setdiff1d(stored_ids, live_ids).tolist())
+        # Tombstoned ids are still in the index, so they are never reissued
+        self._next_id = max(int(stored_ids.max(initial=-1)), max(chunk_ids, default=-1)) + 1
+    
+    def _set_removed(self, removed):
+        """Replace the tombstone set and the search filter that skips it"""
+        import faiss
+        
+        self._removed = set(removed)
+        if not self._removed:
+            self._removed_filter = None
+            return
+        
+        # IDSelectorNot doesn't own the batch selector, so both are kept
+        batch = faiss.IDSelectorBatch(np.fromiter(self._removed, dtype=np.int64))
+        self._removed_filter = (faiss.IDSelectorNot(batch), batch)
+    
+    def _migrate_positional(self, chunk_ids: List[str]):
+        """Convert an index saved with a positional chunk_id list to the id-mapped layout"""
+        vectors = self.index.reconstruct_n(0, self.index.ntotal) if self.index.ntotal else None
+        self.index = self._build_index(vectors, np.arange(len(chunk_ids), dtype=np.int64))
+        self._mmapped = False
+        self._set_mapping(dict(enumerate(chunk_ids)))
         self._save_index()
     
-    def remove_chunks(self, chunk_ids_to_remove: List[str]):
-        """Remove chunks from index (requires rebuild)"""
+    @property
+    def _base_index(self):
+        """The index wrapped by the id map"""
         import faiss
         
-        indices_to_keep = [
-            i for i, cid in enumerate(self.chunk_ids) 
-            if cid not in chunk_ids_to_remove
-        ]
+        return faiss.downcast_index(self.index.index)
+    
+    def _stored_vectors(self) -> Tuple[np.ndarray, np.ndarray]:
+        """All stored vectors and their FAISS ids, in storage order"""
+        import faiss
         
-        if len(indices_to_keep) == len(self.chunk_ids):
-            return  # Nothing to remove
+        base = self._base_index
+        return base.reconstruct_n(0, base.ntotal), faiss.vector_to_array(self.index.id_map)
+    
+    @staticmethod
+    def _use_hnsw(size: int) -> bool:
+        """Whether an index expected to hold `size` vectors should be HNSW"""
+        if settings.VECTOR_INDEX_TYPE == "auto":
+            return size >= settings.HNSW_AUTO_THRESHOLD
+        return settings.VECTOR_INDEX_TYPE == "hnsw"
+    
+    def _layout(self, size: int) -> Tuple[bool, str]:
+        """(HNSW?, storage) for an index expected to hold `size` vectors"""
+        storage = settings.VECTOR_STORAGE
+        if storage == "int8" and size < settings.VECTOR_INT8_MIN_VECTORS:
+            # int8 ranges are trained on the stored vectors, so the index
+            # stays fp16 until there are enough of them
+            storage = "fp16"
+        return self._use_hnsw(size), storage
+    
+    def _current_layout(self) -> Tuple[bool, str]:
+        """(HNSW?, storage) of the loaded index"""
+        import faiss
         
-        # Rebuild index with remaining vectors
-        if indices_to_keep:
-            # Get vectors to keep
-            vectors = np.array([
-                self.index.reconstruct(i) for i in indices_to_keep
-            ])
-            
-            # Create new index
-            self.index = faiss.IndexFlatIP(settings.EMBEDDING_DIMENSION)
-            self.index.add(vectors)
-            self.chunk_ids = [self.chunk_ids[i] for i in indices_to_keep]
+        base = self._base_index
+        hnsw = hasattr(base, "hnsw")
+        storage_index = faiss.downcast_index(base.storage) if hnsw else base
+        if isinstance(storage_index, faiss.IndexScalarQuantizer):
+            int8 = storage_index.sq.qtype == faiss.ScalarQuantizer.QT_8bit
+            return hnsw, "int8" if int8 else "fp16"
+        return hnsw, "fp32"
+    
+    def _new_index(self, size: int = 0):
+        """
+        Empty inner-product index (cosine sim for normalized vectors).
+        - VECTOR_STORAGE="fp16" stores vectors as half floats, halving
+          memory and bytes scanned per search (scores accumulate in fp32)
+        - VECTOR_STORAGE="int8" stores one byte per dimension with
+          per-dimension ranges trained on the vectors (see _build_index),
+          a quarter of fp32, once VECTOR_INT8_MIN_VECTORS are stored
+        - VECTOR_INDEX_TYPE="hnsw" builds an HNSW graph so a search visits
+          O(log N) vectors instead of scanning all of them; worth it past
+          ~100k chunks, at a small recall cost tuned by HNSW_EF_SEARCH
+        - VECTOR_INDEX_TYPE="auto" uses the exact scan for small corpora
+          and HNSW once `size` reaches HNSW_AUTO_THRESHOLD
+        The index is wrapped in IndexIDMap2 so vectors carry stable ids.
+        """
+        import faiss
+        
+        dim = settings.EMBEDDING_DIMENSION
+        hnsw, storage = self._layout(size)
+        qtype = {
+            "fp16": faiss.ScalarQuantizer.QT_fp16,
+            "int8": faiss.ScalarQuantizer.QT_8bit
+        }.get(storage)
+        
+        if hnsw:
+            if qtype is not None:
+                index = faiss.IndexHNSWSQ(dim, qtype, settings.HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            else:
+                index = faiss.IndexHNSWFlat(dim, settings.HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = settings.HNSW_EF_CONSTRUCTION
+            index.hnsw.efSearch = settings.HNSW_EF_SEARCH
+        elif qtype is not None:
+            index = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_INNER_PRODUCT)
         else:
-            # Empty index
-            self.index = faiss.IndexFlatIP(settings.EMBEDDING_DIMENSION)
-            self.chunk_ids = []
+            index = faiss.IndexFlatIP(dim)
+        return faiss.IndexIDMap2(index)
+    
+    def _build_index(self, vectors: Optional[np.ndarray] = None, ids: Optional[np.ndarray] = None):
+        """New index laid out for len(vectors), trained on them if it needs to be, holding them"""
+        index = self._new_index(0 if vectors is None else len(vectors))
+        if vectors is not None and len(vectors):
+            if not index.is_trained:
+                sample = vectors
+                if len(vectors) > SQ_TRAIN_SAMPLE:
+                    rng = np.random.default_rng(0)
+                    sample = vectors[rng.choice(len(vectors), SQ_TRAIN_SAMPLE, replace=False)]
+                index.train(sample)
+            index.add_with_ids(vectors, ids)
+        return index
+    
+    def rebuild(self, persist: bool = True):
+        """
+        Re-create the index with the current settings (e.g. after changing
+        VECTOR_INDEX_TYPE or VECTOR_STORAGE) and persist it. Also compacts
+        away vectors removed from an HNSW index.
+        """
+        with self._write_lock:
+            vectors, ids = self._stored_vectors()
+            if self._removed:
+                keep = ~np.isin(ids, np.fromiter(self._removed, dtype=np.int64))
+                vectors, ids = vectors[keep], ids[keep]
+            self.index = self._build_index(vectors, ids)
+            self._set_removed(())
+            self._mmapped = False
+            self._gpu_index, self._gpu_unavailable = None, False
+            if persist:
+                self._save_index()
+    
+    def _maybe_promote(self, persist: bool = True):
+        """
+        Rebuild the index once its size calls for another layout: flat to
+        HNSW in "auto" mode, fp16 to trained int8 for VECTOR_STORAGE="int8".
+        Checked at startup and on flush(), never per add.
+        """
+        hnsw, storage = self._layout(len(self.chunk_ids))
+        if (hnsw, storage) != self._current_layout():
+            kind = "HNSW" if hnsw else "flat"
+            print(f"✓ Rebuilding FAISS index as {kind}/{storage} ({len(self.chunk_ids)} vectors)")
+            self.rebuild(persist)
+    
+    def add_chunks(self, chunk_ids: List[str], contents: List[str], persist: bool = True):
+        """Add chunks to the index (persist=False defers the disk write to flush())"""
+        if not chunk_ids or not contents:
+            return
         
-        self._save_index()
+        # Sort by length so each micro-batch pads to a similar length
+        # (encode() only length-sorts within a single call); index
+        # positions don't need to follow document order
+        order = sorted(range(len(contents)), key=lambda i: len(contents[i]))
+        chunk_ids = [chunk_ids[i] for i in order]
+        contents = [contents[i] for i in order]
+        
+        # Embed and add in micro-batches so a large document never holds
+        # all of its embeddings in memory at once
+        batch_size = settings.EMBEDDING_BATCH_SIZE
+        for start in range(0, len(contents), batch_size):
+            embeddings = embedding_service.embed_batch(contents[start:start + batch_size])
+            self.add_embeddings(chunk_ids[start:start + batch_size], embeddings, persist=False)
+        
+        # Persist once for the whole call
+        if persist:
+            self.flush()
+    
+    def add_embeddings(self, chunk_ids: List[str], embeddings: np.ndarray, persist: bool = True):
+        """Add precomputed embeddings to the index"""
+        if not chunk_ids:
+            return
+        
+        with self._write_lock:
+            self._ensure_writable()
+            self._gpu_index = None
+            ids = list(range(self._next_id, self._next_id + len(chunk_ids)))
+            self._next_id += len(chunk_ids)
+            
+            vectors = embeddings.astype(np.float32)
+            with self._modifying_index():
+                self.index.add_with_ids(vectors, np.array(ids, dtype=np.int64))
+            self.chunk_ids.update(zip(ids, chunk_ids))
+            self._faiss_ids.update(zip(chunk_ids, ids))
+            
+            if persist:
+                self.flush()
+    
+    def remove_chunks(self, chunk_ids_to_remove: List[str], persist: bool = True):
+        """
+        Remove chunks from index. Flat indexes drop the vectors in place;
+        HNSW indexes tombstone them (see rebuild())
+        """
+        with self._write_lock:
+            ids = [
+                self._faiss_ids.pop(chunk_id)
+                for chunk_id in chunk_ids_to_remove
+                if chunk_id in self._faiss_ids
+            ]
+            if not ids:
+                return  # Nothing to remove
+            
+            for faiss_id in ids:
+                del self.chunk_ids[faiss_id]
+            ids = np.array(ids, dtype=np.int64)
+            
+            if hasattr(self._base_index, "hnsw"):
+                # Rebuilding the graph costs seconds per delete at HNSW sizes;
+                # searches filter the ids out instead
+                self._set_removed(self._removed.union(ids.tolist()))
+            else:
+                # Flat storage removes in place, without reconstructing vectors
+                self._ensure_writable()
+                self._gpu_index = None
+                with self._modifying_index():
+                    self.index.remove_ids(ids)
+            
+            if persist:
+                self._save_index()
     
     def search(
         self,
         query: str,
-        top_k: int = 10
+        top_k: int = 10,
+        query_embedding: Optional[np.ndarray] = None
     ) -> List[Tuple[str, float]]:
         """
         Search for similar chunks.
         Returns list of (chunk_id, similarity_score) tuples.
         """
-        if self.index.ntotal == 0:
-            return []
+        query_embeddings = None if query_embedding is None else query_embedding.reshape(1, -1)
+        return self.search_batch([query], top_k, query_embeddings)[0]
+    
+    def search_batch(
+        self,
+        queries: List[str],
+        top_k: int = 10,
+        query_embeddings: Optional[np.ndarray] = None
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        search() for several queries with one embed_batch call and one
+        index.search over the stacked (nq, d) matrix, which FAISS
+        spreads across threads.
+        """
+        if self.index.ntotal == 0 or not queries:
+            return [[] for _ in queries]
         
-        # Embed query
-        query_embedding = embedding_service.embed_text(query)
-        query_embedding = query_embedding.reshape(1, -1).astype(np.float32)
+        # Embed queries unless the caller already did
+        if query_embeddings is None:
+            query_embeddings = embedding_service.embed_batch(queries)
+        query_embeddings = np.ascontiguousarray(query_embeddings, dtype=np.float32)
         
-        # Search
+        # Large batches of queries go to the GPU copy when there is one;
+        # single queries don't gain enough to pay for the transfer. The copy
+        # is made under the write lock, but a search never waits on a
+        # rebuild for it and just stays on the CPU.
         k = min(top_k, self.index.ntotal)
-        scores, indices = self.index.search(query_embedding, k)
+        gpu_index = None
+        if len(query_embeddings) >= settings.VECTOR_GPU_BATCH_THRESHOLD and k <= GPU_MAX_K:
+            if self._write_lock.acquire(blocking=False):
+                try:
+                    gpu_index = self._get_gpu_index()
+                finally:
+                    self._write_lock.release()
         
-        # Map to chunk IDs
-        results = []
-        for score, idx in zip(scores[0], indices[0]):
-            if idx >= 0 and idx < len(self.chunk_ids):
-                results.append((self.chunk_ids[idx], float(score)))
+        with self._searching():
+            # One consistent view; writers may swap these right after
+            index = self.index if gpu_index is None else gpu_index
+            chunk_ids = self.chunk_ids
+            removed_filter = self._removed_filter
+            # Only HNSW indexes have tombstones, and those never move to the
+            # GPU. SearchParameters is per call: IndexIDMap2 swaps its
+            # selector during a search, so a shared one isn't thread-safe.
+            params = None
+            if removed_filter is not None:
+                import faiss
+                
+                params = faiss.SearchParameters(sel=removed_filter[0])
+            scores, indices = index.search(query_embeddings, k, params=params)
         
-        return results
+        # Map FAISS ids to chunk IDs (-1 pads rows with fewer than k hits;
+        # ids removed or added since the search started aren't mapped)
+        return [
+            [
+                (chunk_id, score)
+                for score, idx in zip(row_scores.tolist(), row_indices.tolist())
+                if idx >= 0 and (chunk_id := chunk_ids.get(idx)) is not None
+            ]
+            for row_scores, row_indices in zip(scores, indices)
+        ]
+    
+    def warmup(self):
+        """
+        One throwaway search, so the first query doesn't pay for thread
+        pool startup or for faulting a memory-mapped index into memory
+        """
+        with self._searching():
+            if self.index.ntotal:
+                self.index.search(np.zeros((1, settings.EMBEDDING_DIMENSION), dtype=np.float32), 1)
+    
+    def flush(self):
+        """
+        Persist changes made with persist=False. A layout promotion the
+        index has grown into happens here, once per burst of adds, rather
+        than in the middle of one.
+        """
+        with self._write_lock:
+            self._maybe_promote(persist=False)
+            self._save_index()
     
     def _save_index(self):
         """Persist index to disk"""
         import faiss
         
-        faiss.write_index(self.index, str(self.index_path))
-        with open(self.mapping_path, "wb") as f:
-            pickle.dump(self.chunk_ids, f)
+        with self._write_lock:
+            # Write to temp files and rename over the old ones, so a mapped
+            # index file is never truncated underneath its readers
+            index_tmp = self.index_path.with_suffix(".tmp")
+            faiss.write_index(self.index, str(index_tmp))
+            os.replace(index_tmp, self.index_path)
+            
+            records = np.array(
+                list(self.chunk_ids.items()),
+                dtype=[("faiss_id", np.int64), ("chunk_id", "S36")]
+            )
+            mapping_tmp = self.mapping_path.with_suffix(".tmp.npy")
+            np.save(mapping_tmp, records)
+            os.replace(mapping_tmp, self.mapping_path)
     
     def get_stats(self) -> dict:
         """Get index statistics"""
         return {
-            "total_vectors": self.index.ntotal,
+            "total_vectors": len(self.chunk_ids),
+            "removed_vectors": len(self._removed),  # Reclaimed by rebuild()
             "dimension": settings.EMBEDDING_DIMENSION,
             "index_size_bytes": self.index_path.stat().st_size if self.index_path.exists() else 0
         }
@@ -0,0 +1,37 @@
+"""
+Bloom filter for keys that are already uniform hashes (hex digests)
+"""
+import math
+from typing import Iterable, Iterator
+
+
+class HashBloomFilter:
+    """
+    Probabilistic set of hex digests: no false negatives, and about
+    `error_rate` false positives while it holds up to `capacity` keys.
+    Bit positions are taken from the digest itself (double hashing),
+    so keys are never rehashed.
+    """
+    
+    def __init__(self, capacity: int, error_rate: float = 1e-4):
+        capacity = max(1, capacity)
+        self.num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+    
+    def _positions(self, digest: str) -> Iterator[int]:
+        h1 = int(digest[:16], 16)
+        h2 = int(digest[16:32], 16) | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+    
+    def add(self, digest: str):
+        for pos in self._positions(digest):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+    
+    def update(self, digests: Iterable[str]):
+        for digest in digests:
+            self.add(digest)
+    
+    def __contains__(self, digest: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(digest))
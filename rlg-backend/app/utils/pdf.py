@@ -0,0 +1,13 @@
+"""
+PDF helpers that run in worker processes
+Kept free of app imports so spawned workers start quickly
+"""
+from typing import List
+
+
+def extract_page_texts(path: str, start: int, stop: int) -> List[str]:
+    """Plain text of pages [start, stop) via PyMuPDF (opened in the worker)"""
+    import pymupdf
+    
+    with pymupdf.open(path) as doc:
+        return [doc[i].get_text("text") for i in range(start, stop)]
@@ -1,9 +1,29 @@
 """
 Scoring utilities for retrieval and ranking
 """
-from typing import List, Dict
+from typing import List, Dict, Optional
+from collections import Counter
 import math
 
+import numpy as np
+
+from app.utils.tokenizer import tokenize_tuple
+
+
+# Below this many query terms bm25_score() counts only the query's terms
+SMALL_QUERY_TERMS = 8
+
+
+def _idf(df: int, doc_count: int) -> float:
+    return math.log((doc_count - df + 0.5) / (df + 0.5) + 1)
+
+
+def precompute_idf(term_doc_freq: Dict[str, int], doc_count: int) -> Dict[str, float]:
+    """IDF per term, computed once per corpus and passed to bm25_score(idf=...)"""
+    doc_freq = np.fromiter(term_doc_freq.values(), dtype=np.float64, count=len(term_doc_freq))
+    idf = np.log((doc_count - doc_freq + 0.5) / (doc_freq + 0.5) + 1)
+    return dict(zip(term_doc_freq, idf.tolist()))
+
 
 def bm25_score(
     query_terms: List[str],
@@ -12,7 +32,8 @@ def bm25_score(
     doc_count: int,
     term_doc_freq: Dict[str, int],
     k1: float = 1.5,
-    b: float = 0.75
+    b: float = 0.75,
+    idf: Optional[Dict[str, float]] = None
 ) -> float:
     """
     Compute BM25 score for a document given query terms.
@@ -25,6 +46,8 @@ def bm25_score(
         term_doc_freq: Dict of term -> number of docs containing term
         k1: Term saturation parameter
         b: Length normalization parameter
+        idf: Optional precompute_idf() table, so scoring many documents
+            doesn't recompute the same logs
     
     Returns:
         BM25 score
@@ -32,10 +55,18 @@ def bm25_score(
     doc_terms = document.lower().split()
     doc_length = len(doc_terms)
     
-    # Term frequency in document
-    term_freq = {}
-    for term in doc_terms:
-        term_freq[term] = term_freq.get(term, 0) + 1
+    # Term frequency in document; for short queries only the query's own
+    # terms are counted, so the Counter stays query-sized
+    if len(query_terms) < SMALL_QUERY_TERMS:
+        wanted = set(query_terms)
+        term_freq = Counter(t for t in doc_terms if t in wanted)
+    else:
+        term_freq = Counter(doc_terms)
+    
+    # Length normalization and the TF numerator factor are the same for
+    # every term of this document
+    length_norm = k1 * (1 - b + b * doc_length / avg_doc_length)
+    saturation = k1 + 1
     
     score = 0.0
     for term in query_terms:
@@ -43,19 +74,85 @@ def bm25_score(
             continue
         
         tf = term_freq[term]
-        df = term_doc_freq.get(term, 0)
         
         # IDF component
-        idf = math.log((doc_count - df + 0.5) / (df + 0.5) + 1)
+        term_idf = idf.get(term) if idf is not None else None
+        if term_idf is None:
+            term_idf = _idf(term_doc_freq.get(term, 0), doc_count)
         
         # TF component with length normalization
-        tf_component = (tf * (k1 + 1)) / (tf + k1 * (1 - b + b * doc_length / avg_doc_length))
+        tf_component = tf * saturation / (tf + length_norm)
         
-        score += idf * tf_component
+        score += term_idf * tf_component
     
     return score
 
 
+class BM25Index:
+    """
+    BM25 over a fixed corpus. Postings are grouped by term and each one
+    already holds its term's full BM25 contribution to its document
+    (both idf and tf saturation are fixed once the corpus is), so scoring
+    a query is one slice-and-add per query term instead of a
+    bm25_score() call per document.
+    
+    Weights and scores are float32 (only their order matters for
+    ranking), so they can differ from bm25_score() around the 7th
+    significant digit.
+    """
+    
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.vocab: Dict[str, int] = {}
+        self.doc_count = 0
+    
+    def fit(self, documents: List[str]) -> "BM25Index":
+        """Index documents (row order is the order of score() results)"""
+        vocab: Dict[str, int] = {}
+        rows, cols, counts = [], [], []
+        for row, document in enumerate(documents):
+            for term, count in Counter(tokenize_tuple(document)).items():
+                rows.append(row)
+                cols.append(vocab.setdefault(term, len(vocab)))
+                counts.append(count)
+        
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.float64)
+        
+        # Postings of term t are _doc_ids/_weights[_offsets[t]:_offsets[t + 1]]
+        order = np.argsort(cols, kind="stable")
+        rows, cols, counts = rows[order], cols[order], counts[order]
+        doc_freq = np.bincount(cols, minlength=len(vocab))
+        self._offsets = np.concatenate(([0], np.cumsum(doc_freq)))
+        
+        self.vocab = vocab
+        self.doc_count = len(documents)
+        self.doc_lengths = np.bincount(rows, weights=counts, minlength=self.doc_count)
+        avg_doc_length = self.doc_lengths.mean() if self.doc_count else 0.0
+        
+        self.idf = np.log((self.doc_count - doc_freq + 0.5) / (doc_freq + 0.5) + 1)
+        length_norm = self.k1 * (1 - self.b + self.b * self.doc_lengths / (avg_doc_length or 1.0))
+        
+        self._doc_ids = rows
+        self._weights = (
+            self.idf[cols] * counts * (self.k1 + 1) / (counts + length_norm[rows])
+        ).astype(np.float32)
+        return self
+    
+    def score(self, query_terms: List[str]) -> np.ndarray:
+        """BM25 score of every document for the query terms"""
+        scores = np.zeros(self.doc_count, dtype=np.float32)
+        for term in query_terms:
+            col = self.vocab.get(term)
+            if col is None:
+                continue
+            start, end = self._offsets[col], self._offsets[col + 1]
+            scores[self._doc_ids[start:end]] += self._weights[start:end]
+        return scores
+
+
 def compute_recall(
     retrieved: List[str],
     relevant: List[str]
@@ -85,10 +182,14 @@ def compute_f1(
     relevant: List[str]
 ) -> float:
     """Compute F1 score"""
-    precision = compute_precision(retrieved, relevant)
-    recall = compute_recall(retrieved, relevant)
-    if precision + recall == 0:
+    # One set conversion each, shared by precision and recall
+    retrieved_set = set(retrieved)
+    relevant_set = set(relevant)
+    hits = len(retrieved_set & relevant_set)
+    if not hits:
         return 0.0
+    precision = hits / len(retrieved_set)
+    recall = hits / len(relevant_set)
     return 2 * (precision * recall) / (precision + recall)
 
 
@@ -106,18 +207,32 @@ def compute_mrr(
     Returns:
         MRR score
     """
-    relevant_set = set(relevant_items)
-    reciprocal_ranks = []
+    if not rankings:
+        return 0.0
     
-    for ranking in rankings:
-        for i, item in enumerate(ranking, 1):
-            if item in relevant_set:
-                reciprocal_ranks.append(1 / i)
-                break
-        else:
-            reciprocal_ranks.append(0.0)
+    relevant_set = frozenset(relevant_items)
     
-    return sum(reciprocal_ranks) / len(reciprocal_ranks) if reciprocal_ranks else 0.0
+    # Reciprocal rank of the first relevant item; the generator stops there
+    total = sum(
+        next((1 / i for i, item in enumerate(ranking, 1) if item in relevant_set), 0.0)
+        for ranking in rankings
+    )
+    return total / len(rankings)
+
+
+def _normalize_rows(scores: np.ndarray) -> np.ndarray:
+    """
+    Min-max normalize each row of a 2-D array (a constant row becomes
+    all 1.0). Callers pass float32: normalized scores only need to rank,
+    so values may differ from exact arithmetic around the 7th digit.
+    """
+    lows = scores.min(axis=1, keepdims=True)
+    ranges = scores.max(axis=1, keepdims=True) - lows
+    constant = ranges[:, 0] == 0
+    ranges[constant] = 1.0
+    normalized = (scores - lows) / ranges
+    normalized[constant] = 1.0
+    return normalized
 
 
 def normalize_scores(scores: List[float]) -> List[float]:
@@ -125,13 +240,8 @@ def normalize_scores(scores: List[float]) -> List[float]:
     if not scores:
         return []
     
-    min_score = min(scores)
-    max_score = max(scores)
-    
-    if max_score == min_score:
-        return [1.0] * len(scores)
-    
-    return [(s - min_score) / (max_score - min_score) for s in scores]
+    values = np.fromiter(scores, dtype=np.float32, count=len(scores))
+    return _normalize_rows(values[None, :])[0].tolist()
 
 
 def combine_scores(
@@ -148,18 +258,10 @@ def combine_scores(
     if len(scores_list) != len(weights):
         raise ValueError("Number of score lists must match number of weights")
     
-    # Normalize each score list
-    normalized = [normalize_scores(scores) for scores in scores_list]
-    
-    # Combine with weights
-    combined = []
-    num_items = len(normalized[0])
-    
-    for i in range(num_items):
-        weighted_sum = sum(
-            normalized[j][i] * weights[j]
-            for j in range(len(weights))
-        )
-        combined.append(weighted_sum / sum(weights))
+    scores = np.asarray(scores_list, dtype=np.float32)
+    if scores.shape[1] == 0:
+        return []
     
-    return combined
+    # Normalize each score list, then combine with weights
+    w = np.asarray(weights, dtype=np.float32)
+    return (w @ _normalize_rows(scores) / w.sum()).tolist()
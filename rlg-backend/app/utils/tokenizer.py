@@ -1,12 +1,19 @@
 """
 Tokenizer utilities for text processing
 """
+import hashlib
+import os
 import re
-from typing import List, Set
+import string
+from collections import Counter
+from functools import lru_cache
+from typing import FrozenSet, List, Tuple
+
+from app.core.config import settings
 
 
 # Common English stopwords
-STOPWORDS: Set[str] = {
+STOPWORDS: FrozenSet[str] = frozenset({
     "a", "an", "and", "are", "as", "at", "be", "been", "being", "but", "by",
     "can", "could", "did", "do", "does", "doing", "done", "for", "from",
     "had", "has", "have", "having", "he", "her", "here", "hers", "herself",
@@ -19,17 +26,41 @@ STOPWORDS: Set[str] = {
     "to", "too", "under", "until", "up", "very", "was", "we", "were", "what",
     "when", "where", "which", "while", "who", "whom", "why", "will", "with",
     "would", "you", "your", "yours", "yourself", "yourselves"
-}
+})
+
+# Fallback ratio for estimate_tokens() without a real tokenizer
+CHARS_PER_TOKEN = 4
+
+# Compiled once; \b keeps runs glued to '_' or non-ASCII letters out
+_TOKEN_RE = re.compile(r'\b[a-z0-9]+\b')
+
+# ASCII fast path for the same tokens: word characters survive, everything
+# else becomes a space; '_' is kept so that runs glued to it can be dropped
+_ASCII_WORD_CHARS = frozenset(string.ascii_lowercase + string.digits + "_")
+_ASCII_TOKEN_TABLE = str.maketrans({
+    chr(c): chr(c) if chr(c) in _ASCII_WORD_CHARS else " " for c in range(128)
+})
+
+
+@lru_cache(maxsize=4096)
+def tokenize_tuple(text: str) -> Tuple[str, ...]:
+    """
+    tokenize() as a memoized, immutable tuple. Callers that only read the
+    tokens should use this and skip tokenize()'s list copy.
+    """
+    text = text.lower()
+    if text.isascii():
+        return tuple([t for t in text.translate(_ASCII_TOKEN_TABLE).split() if "_" not in t])
+    return tuple(_TOKEN_RE.findall(text))
 
 
 def tokenize(text: str) -> List[str]:
     """
     Tokenize text into words.
-    Lowercases and removes punctuation.
+    Lowercases and removes punctuation. Returns a fresh list the caller
+    may modify; see tokenize_tuple() for read-only use.
     """
-    text = text.lower()
-    words = re.findall(r'\b[a-z0-9]+\b', text)
-    return words
+    return list(tokenize_tuple(text))
 
 
 def tokenize_without_stopwords(text: str) -> List[str]:
@@ -37,13 +68,13 @@ def tokenize_without_stopwords(text: str) -> List[str]:
     Tokenize text and remove stopwords.
     Useful for keyword extraction.
     """
-    tokens = tokenize(text)
-    return [t for t in tokens if t not in STOPWORDS and len(t) > 2]
+    # Length first: short tokens are common and cheaper to reject than to hash
+    return [t for t in tokenize_tuple(text) if len(t) > 2 and t not in STOPWORDS]
 
 
 def extract_ngrams(text: str, n: int = 2) -> List[str]:
     """Extract n-grams from text"""
-    tokens = tokenize(text)
+    tokens = tokenize_tuple(text)
     if len(tokens) < n:
         return []
     return [" ".join(tokens[i:i+n]) for i in range(len(tokens) - n + 1)]
@@ -54,45 +85,76 @@ def extract_key_phrases(text: str, max_phrases: int = 5) -> List[str]:
     Extract key phrases using simple frequency analysis.
     Returns most important phrases.
     """
-    # Get bigrams and trigrams
-    bigrams = extract_ngrams(text, 2)
-    trigrams = extract_ngrams(text, 3)
-    
-    # Filter out phrases with stopwords at boundaries
-    phrases = []
-    for phrase in bigrams + trigrams:
-        words = phrase.split()
-        if words[0] not in STOPWORDS and words[-1] not in STOPWORDS:
-            phrases.append(phrase)
+    # Count bigrams then trigrams straight from token indices; a phrase
+    # string is only built once its boundary tokens pass the stopword check
+    tokens = tokenize_tuple(text)
+    freq = Counter(
+        " ".join(tokens[i:i + n])
+        for n in (2, 3)
+        for i in range(len(tokens) - n + 1)
+        if tokens[i] not in STOPWORDS and tokens[i + n - 1] not in STOPWORDS
+    )
     
-    # Count frequency
-    freq = {}
-    for phrase in phrases:
-        freq[phrase] = freq.get(phrase, 0) + 1
+    # Top phrases (most_common(n) selects with a heap instead of sorting
+    # every distinct phrase)
+    return [phrase for phrase, count in freq.most_common(max_phrases)]
+
+
+# tiktoken caches each BPE file under the SHA-1 of its download URL
+_CL100K_URL = "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken"
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    """
+    tiktoken's cl100k_base encoding, or None when tiktoken isn't installed
+    or its BPE file isn't already cached locally. tiktoken would otherwise
+    download it on first use, stalling (or failing) a query offline.
+    """
+    cache_dir = settings.TIKTOKEN_CACHE_DIR
+    if not (cache_dir / hashlib.sha1(_CL100K_URL.encode()).hexdigest()).is_file():
+        return None
     
-    # Sort by frequency and return top phrases
-    sorted_phrases = sorted(freq.items(), key=lambda x: x[1], reverse=True)
-    return [phrase for phrase, count in sorted_phrases[:max_phrases]]
+    os.environ["TIKTOKEN_CACHE_DIR"] = str(cache_dir)  # Where tiktoken looks
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
 
 
+@lru_cache(maxsize=8192)
 def estimate_tokens(text: str) -> int:
     """
-    Estimate token count (roughly 4 chars per token).
-    For more accurate counts, use the actual tokenizer.
+    Estimate token count with tiktoken when available (close to, though
+    not exactly, the local models' own tokenizers), else roughly 4 chars
+    per token. Cached, since the same chunks are counted for every
+    prompt they appear in.
     """
-    return len(text) // 4
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN
+    return len(encoding.encode(text, disallowed_special=()))
 
 
 def truncate_to_tokens(text: str, max_tokens: int) -> str:
-    """Truncate text to approximate token limit"""
-    max_chars = max_tokens * 4
-    if len(text) <= max_chars:
-        return text
+    """Truncate text to a token limit (approximate without tiktoken)"""
+    encoding = _encoding()
+    if encoding is None:
+        max_chars = max_tokens * CHARS_PER_TOKEN
+        if len(text) <= max_chars:
+            return text
+        truncated = text[:max_chars]
+    else:
+        # Encode once and cut at exactly max_tokens
+        ids = encoding.encode(text, disallowed_special=())
+        if len(ids) <= max_tokens:
+            return text
+        truncated = encoding.decode(ids[:max_tokens])
     
     # Try to truncate at sentence boundary
-    truncated = text[:max_chars]
     last_period = truncated.rfind(".")
-    if last_period > max_chars * 0.8:
+    if last_period > len(truncated) * 0.8:
         return truncated[:last_period + 1]
     
     return truncated + "..."
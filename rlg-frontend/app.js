@@ -432,7 +432,7 @@ class RLGApp {
         }[doc.file_type] || 'txt';
         
         const statusColor = doc.status === 'indexed' ? 'var(--accent-success)' : 
-                           doc.status === 'processing' ? 'var(--accent-warning)' : 
+                           doc.status === 'processing' || doc.status === 'pending' ? 'var(--accent-warning)' : 
                            'var(--accent-danger)';
         
         return `
@@ -552,9 +552,10 @@ class RLGApp {
                 this.loadDocuments();
                 this.loadAnalytics();
                 
-                // Show success message
-                this.addMessage(`Document "${data.filename}" uploaded successfully! It has ${data.chunk_count} chunks ready for querying.`, 'assistant');
+                // Indexing runs in the background; report when it settles
+                this.addMessage(`Document "${data.filename}" uploaded successfully! Indexing is in progress; it can be queried once it is indexed.`, 'assistant');
                 this.switchSection('chat');
+                this.watchIndexing(data.id, data.filename);
             } else {
                 const error = await response.json();
                 alert(`Upload failed: ${error.detail || 'Unknown error'}`);
@@ -567,6 +568,33 @@ class RLGApp {
         }
     }
     
+    async watchIndexing(docId, filename) {
+        // Poll until the pipeline marks the document indexed or failed
+        for (;;) {
+            await new Promise(resolve => setTimeout(resolve, 2000));
+            
+            let doc;
+            try {
+                const response = await fetch(`${this.apiUrl}/documents/${docId}`);
+                if (!response.ok) return;  // Deleted meanwhile
+                doc = await response.json();
+            } catch (e) {
+                continue;
+            }
+            
+            this.loadDocuments();
+            if (doc.status === 'indexed') {
+                this.loadAnalytics();
+                this.addMessage(`Document "${filename}" is indexed: ${doc.chunk_count} chunks ready for querying.`, 'assistant');
+                return;
+            }
+            if (doc.status === 'failed') {
+                this.addMessage(`Indexing "${filename}" failed: ${doc.error_message || 'Unknown error'}`, 'assistant');
+                return;
+            }
+        }
+    }
+    
     async deleteDocument(docId) {
         if (!confirm('Are you sure you want to delete this document?')) return;
         